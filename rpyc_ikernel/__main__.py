@@ -8,4 +8,6 @@ that a kernel is required instead and instance one instead.
 from ipykernel.kernelapp import IPKernelApp
 from .kernel import RPycKernel
 
-IPKernelApp.launch_instance(kernel_class=RPycKernel)
+# guarded so spawned worker processes (FrameTransform) do not launch a kernel
+if __name__ == '__main__':
+    IPKernelApp.launch_instance(kernel_class=RPycKernel)
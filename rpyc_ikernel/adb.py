@@ -7,7 +7,227 @@
 import sys
 import os
 import re
+import asyncio
+import socket
 import subprocess
+import threading
+import queue
+import time
+import uuid
+from collections import deque, namedtuple
+
+from .adb_client import AdbClient, AdbError, AdbServerError
+from .devices import DEFAULT_PORTS
+from .health import HealthChecker
+
+
+class AdbShell():
+    '''
+    One long running `adb shell` that commands are written to, instead of
+    a new adb process per command. The output of every command ends with a
+    unique sentinel line carrying its exit status. The shell is respawned
+    when it dies.
+    '''
+
+    def __init__(self, command):
+        self.command = command
+        self.__proc = None
+        self.__lines = None
+        self.__lock = threading.Lock()
+
+    def __spawn(self):
+        self.close()
+        self.__proc = subprocess.Popen(self.command, stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT,
+                                       shell=False)
+        self.__lines = queue.Queue()
+        threading.Thread(target=self.__read, args=(self.__proc, self.__lines), daemon=True).start()
+
+    @staticmethod
+    def __read(proc, lines):
+        for line in iter(proc.stdout.readline, b''):
+            lines.put(line)
+        lines.put(None)
+
+    def alive(self):
+        return self.__proc is not None and self.__proc.poll() is None
+
+    def run(self, cmd, timeout=10):
+        '''
+        Run cmd (a shell command line), returns (output, exit status). The
+        status is None if the shell died before the command finished.
+        '''
+        with self.__lock:
+            if not self.alive():
+                self.__spawn()
+            marker = ('__rpyc_%s__' % uuid.uuid4().hex).encode()
+            # stdin is ours, keep the command from reading the next line off it
+            line = "{ %s\n} </dev/null 2>&1; printf '\\n%s %%d\\n' $?\n" % (cmd, marker.decode())
+            try:
+                self.__proc.stdin.write(line.encode())
+                self.__proc.stdin.flush()
+            except OSError:
+                self.close()
+                return b'', None
+            output = []
+            deadline = time.monotonic() + timeout
+            while True:
+                try:
+                    out = self.__lines.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    self.close()
+                    raise subprocess.TimeoutExpired(cmd, timeout, b''.join(output))
+                if out is None:
+                    self.close()
+                    return b''.join(output), None
+                if out.startswith(marker):
+                    # drop the newline printf put in front of the marker
+                    data = b''.join(output)
+                    data = data[:-1] if data.endswith(b'\n') else data
+                    return data, int(out[len(marker):].strip() or -1)
+                output.append(out.replace(b'\r\n', b'\n'))
+
+    def close(self):
+        proc, self.__proc = self.__proc, None
+        if proc is not None:
+            try:
+                proc.kill()
+                proc.wait()
+            except OSError:
+                pass
+
+
+class AdbResult(namedtuple('AdbResult', 'output error returncode')):
+
+    @property
+    def failed(self):
+        return self.returncode != 0
+
+
+class AdbStats():
+    '''
+    Commands run through ADB since start: how many, how many failed or
+    timed out, and the seconds they took in total.
+    '''
+
+    def __init__(self):
+        self.commands = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds, failed=False, timeout=False):
+        with self._lock:
+            self.commands += 1
+            self.failures += bool(failed or timeout)
+            self.timeouts += bool(timeout)
+            self.seconds += seconds
+
+
+adb_stats = AdbStats()
+
+
+async def _drain(pipe, data):
+    # read as it comes, unlike communicate() nothing is lost on a timeout
+    while True:
+        chunk = await pipe.read(65536)
+        if not chunk:
+            return
+        data += chunk
+
+
+class AdbLoop():
+    '''
+    asyncio loop on a daemon thread, the blocking facade of the ADB
+    coroutines runs them here so callers on any thread can overlap.
+    '''
+
+    def __init__(self):
+        self.__loop = None
+        self.__lock = threading.Lock()
+
+    def loop(self):
+        with self.__lock:
+            if self.__loop is None:
+                self.__loop = asyncio.new_event_loop()
+                threading.Thread(target=self.__loop.run_forever, name='AdbLoop', daemon=True).start()
+            return self.__loop
+
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop()).result()
+
+
+adb_loop = AdbLoop()
+
+
+class AdbStream():
+    '''
+    Output lines of a long running adb command (logcat, dmesg -w, tail -f),
+    read by a background thread into a buffer of maxlen lines. A reader
+    that falls behind loses the oldest lines (counted in dropped), memory
+    stays bounded however chatty the device is.
+    '''
+
+    def __init__(self, stream, close, maxlen=1000):
+        self.received = 0
+        self.dropped = 0
+        self.__stream = stream
+        self.__close = close
+        self.__lines = deque(maxlen=maxlen)
+        self.__ready = threading.Condition()
+        self.__eof = False
+        self.__closed = False
+        threading.Thread(target=self.__read, name='AdbStream', daemon=True).start()
+
+    def __read(self):
+        try:
+            for line in iter(self.__stream.readline, b''):
+                line = line.decode('utf-8', 'replace').rstrip('\r\n')
+                with self.__ready:
+                    if len(self.__lines) == self.__lines.maxlen:
+                        self.dropped += 1
+                    self.__lines.append(line)
+                    self.received += 1
+                    self.__ready.notify_all()
+        except (OSError, ValueError):
+            pass
+        with self.__ready:
+            self.__eof = True
+            self.__ready.notify_all()
+
+    @property
+    def closed(self):
+        '''
+        Closed, or the command ended and every line has been read
+        '''
+        return self.__closed or (self.__eof and not self.__lines)
+
+    def read(self, timeout=None):
+        '''
+        The lines buffered since the last read, waits up to timeout seconds
+        for the first one; [] on timeout or once closed.
+        '''
+        with self.__ready:
+            self.__ready.wait_for(lambda: self.__lines or self.__eof or self.__closed, timeout)
+            lines = list(self.__lines)
+            self.__lines.clear()
+            return lines
+
+    def __iter__(self):
+        while not self.closed:
+            for line in self.read():
+                yield line
+
+    def close(self):
+        with self.__ready:
+            self.__closed = True
+            self.__ready.notify_all()
+        try:
+            self.__close()
+        except OSError:
+            pass
 
 
 class ADB():
@@ -32,8 +252,19 @@ class ADB():
     # default TCP/IP host
     DEFAULT_TCP_HOST = "localhost"
 
-    def __init__(self, adb_path='adb', device=None):
+    # seconds run() and run_sync() wait for adb; run_cmd and the blocking
+    # wrappers on it wait as long as adb runs (wait-for-device, bugreport)
+    DEFAULT_TIMEOUT = 60
+
+    def __init__(self, adb_path='adb', device=None, shell_session=False, backend='subprocess'):
         self.__adb_path = adb_path
+        # backend='socket' talks to the adb server on localhost:5037 (AdbClient)
+        # for the commands it knows, the adb binary still does the rest
+        self.__backend = backend
+        self.__client = AdbClient() if backend == 'socket' else None
+        # run shell commands through one persistent `adb shell` (AdbShell)
+        self.__shell_session = shell_session
+        self.__shell = None
         if sys.platform.startswith('win'):
             exe_path = os.getcwd() + "\\adb\\adb.exe"
             # print(self.__adb_path, exe_path)
@@ -68,7 +299,9 @@ class ADB():
                 # print("It has tried 3 times, please check your devices.")
                 return False
             # print('[W] Init Android_native_debug falied, try again.')
-            self.__init__()
+            if self.__shell is not None:
+                self.__shell.close()
+            self.__init__(self.__adb_path, self.__target, shell_session=self.__shell_session, backend=self.__backend)
             return False
         return True
 
@@ -129,7 +362,7 @@ class ADB():
 
         return ret
 
-    def run_cmd(self, cmd):
+    def run_cmd(self, cmd, timeout=None):
         '''
         Runs a command by using adb tool ($ adb <cmd>)
         cmd have to be a list.
@@ -141,32 +374,229 @@ class ADB():
             self.__return = 1
             return
 
+        try:
+            result = self.run_sync(cmd, timeout)
+        except subprocess.TimeoutExpired as e:
+            result = AdbResult(e.output, 'timeout', 1)
+        (self.__output, self.__error, self.__return) = result
+
+    def run_sync(self, cmd, timeout=DEFAULT_TIMEOUT):
+        '''
+        Blocking run(), returns an AdbResult
+        '''
+        return adb_loop.run(self.run(cmd, timeout))
+
+    async def run(self, cmd, timeout=DEFAULT_TIMEOUT):
+        '''
+        Runs adb <cmd>, returns an AdbResult and leaves get_output() & co
+        alone, so calls may overlap. Raises subprocess.TimeoutExpired after
+        timeout seconds, the adb process is killed then.
+        '''
+        return await self.__timed__(self.__run__(cmd, timeout))
+
+    @staticmethod
+    async def __timed__(coro):
+        # adb_stats for one command, None is a command the socket backend left alone
+        start = time.perf_counter()
+        try:
+            result = await coro
+        except subprocess.TimeoutExpired:
+            adb_stats.record(time.perf_counter() - start, timeout=True)
+            raise
+        if result is not None:
+            adb_stats.record(time.perf_counter() - start, result.failed)
+        return result
+
+    async def __client_run__(self, cmd, timeout):
+        loop = asyncio.get_running_loop()
+        try:
+            return await asyncio.wait_for(loop.run_in_executor(None, self.__client_result__, cmd, timeout), timeout)
+        except asyncio.TimeoutError:
+            raise subprocess.TimeoutExpired(cmd, timeout)
+
+    async def __run__(self, cmd, timeout):
         if not isinstance(cmd, list):
             cmd = cmd.split()
+        if self.__client is not None:
+            result = await self.__client_run__(cmd, timeout)
+            if result is not None:
+                return result
 
         # For compat of windows
         cmd_list = self.__build_command__(cmd)
+        if cmd_list is None:
+            return AdbResult(None, "Must set target device first", 1)
+        if isinstance(cmd_list, str):
+            adb_proc = await asyncio.create_subprocess_shell(cmd_list, stdin=subprocess.DEVNULL,
+                                                             stdout=subprocess.PIPE,
+                                                             stderr=subprocess.PIPE)
+        else:
+            # own process group, a timeout kills whatever it started as well
+            adb_proc = await asyncio.create_subprocess_exec(*cmd_list, stdin=subprocess.DEVNULL,
+                                                            stdout=subprocess.PIPE,
+                                                            stderr=subprocess.PIPE,
+                                                            start_new_session=True)
+        output, error = bytearray(), bytearray()
+        try:
+            await asyncio.wait_for(asyncio.gather(_drain(adb_proc.stdout, output),
+                                                  _drain(adb_proc.stderr, error), adb_proc.wait()), timeout)
+        except asyncio.TimeoutError:
+            try:
+                if hasattr(os, 'killpg'):
+                    os.killpg(adb_proc.pid, 9)
+                else:
+                    adb_proc.kill()
+            except OSError:
+                pass
+            await adb_proc.wait()
+            # what adb printed until then goes with the timeout
+            raise subprocess.TimeoutExpired(cmd_list, timeout, bytes(output), bytes(error))
+        return AdbResult(bytes(output), bytes(error), adb_proc.returncode)
+
+    async def shell(self, cmd, timeout=DEFAULT_TIMEOUT):
+        '''
+        adb shell <cmd>, see run()
+        '''
+        if not isinstance(cmd, list):
+            cmd = [cmd]
+        return await self.run(['shell'] + cmd, timeout)
 
-        adb_proc = subprocess.Popen(cmd_list, stdin=subprocess.PIPE,
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE,
-                                    shell=False)
-        (self.__output, self.__error) = adb_proc.communicate()
-        self.__return = adb_proc.returncode
-
-    def run_shell_cmd(self, cmd):
+    def run_shell_cmd(self, cmd, timeout=None):
         '''
         Executes a shell command
         adb shell <cmd>
         '''
         self.__clean__()
+        if self.__client is not None:
+            sh_cmd = cmd if isinstance(cmd, list) else [cmd]
+            try:
+                result = adb_loop.run(self.__timed__(self.__client_run__(['shell'] + sh_cmd, timeout)))
+            except subprocess.TimeoutExpired:
+                result = AdbResult(None, 'timeout', 1)
+            if result is not None:
+                (self.__output, self.__error, self.__return) = result
+                return self.__output
+        if self.__shell_session:
+            return self.run_session_cmd(cmd)
         if not isinstance(cmd, list):
             cmd = cmd.split()
         sh_cmd = cmd.copy()
         sh_cmd.insert(0, 'shell')
-        self.run_cmd(sh_cmd)
+        self.run_cmd(sh_cmd, timeout)
         return self.__output
 
+    def __client_result__(self, cmd, timeout=None):
+        '''
+        Runs cmd over the adb server socket, returns None if the socket
+        backend does not know cmd or the server is not up, run() then uses
+        the adb binary (which also starts the server). A socket error once
+        the server took the command is a failed result, running it again
+        through the binary could run it twice.
+        '''
+        client, serial = self.__client, self.__target
+        output = b''
+        name, args = cmd[0], [str(arg) for arg in cmd[1:]]
+        try:
+            if name == 'shell' and args:
+                output = client.shell(' '.join(args), serial, timeout)
+            elif name == 'devices':
+                output = ('List of devices attached\n' + ''.join(
+                    '%s\n' % ' '.join(dev) for dev in client.devices())).encode()
+            elif name == 'forward' and args == ['--list']:
+                output = ''.join('%s\n' % ' '.join(fwd) for fwd in client.list_forward()).encode()
+            elif name == 'forward' and len(args) == 2:
+                client.forward(args[0], args[1], serial)
+            elif name == 'push' and len(args) == 2:
+                client.push(args[0], args[1], serial)
+            elif name == 'pull' and len(args) == 2:
+                output = b'%d bytes in' % client.pull(args[0], args[1], serial)
+            elif name == 'get-state' and not args:
+                output = (client.get_state(serial) + '\n').encode()
+            elif name == 'get-serialno' and not args:
+                output = (client.get_serialno(serial) + '\n').encode()
+            elif name == 'version' and not args:
+                output = b'Android Debug Bridge version 1.0.%d\n' % client.version()
+            elif name == 'kill-server' and not args:
+                client.kill_server()
+            else:
+                return None
+        except AdbServerError:
+            return None
+        except AdbError as e:
+            return AdbResult(None, str(e).encode(), 1)
+        except OSError as e:
+            # socket.timeout included
+            return AdbResult(None, str(e).encode() or repr(e).encode(), 1)
+        return AdbResult(output, None, 0)
+
+    def run_session_cmd(self, cmd, timeout=10):
+        '''
+        Executes a shell command through the persistent shell session
+        '''
+        self.__clean__()
+        if isinstance(cmd, list):
+            cmd = ' '.join(cmd)
+        if self.__shell is None or self.__shell.command != self.__build_command__(['shell']):
+            if self.__shell is not None:
+                self.__shell.close()
+            self.__shell = AdbShell(self.__build_command__(['shell']))
+        start = time.perf_counter()
+        try:
+            self.__output, self.__return = self.__shell.run(cmd, timeout)
+        except subprocess.TimeoutExpired as e:
+            self.__output, self.__error, self.__return = e.output, 'timeout', 1
+            adb_stats.record(time.perf_counter() - start, timeout=True)
+        else:
+            adb_stats.record(time.perf_counter() - start, self.__return != 0)
+        if self.__return is None:
+            # the shell went away (no device?), same as a failed adb shell
+            self.__error, self.__return = self.__output, 1
+            self.__output = None
+        return self.__output
+
+    def stream(self, cmd, maxlen=1000):
+        '''
+        Starts a long running command and returns an AdbStream of its output
+        adb <cmd>
+        '''
+        if not isinstance(cmd, list):
+            cmd = cmd.split()
+        if self.__client is not None and cmd[0] == 'shell' and len(cmd) > 1:
+            try:
+                sock = self.__client.open_shell(' '.join(cmd[1:]), self.__target)
+            except AdbServerError:
+                pass
+            else:
+                sock.settimeout(None)
+
+                def close():
+                    sock.shutdown(socket.SHUT_RDWR)
+                    sock.close()
+                return AdbStream(sock.makefile('rb'), close, maxlen)
+        proc = subprocess.Popen(self.__build_command__(cmd), stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                shell=False)
+
+        def close():
+            proc.kill()
+            proc.wait()
+        return AdbStream(proc.stdout, close, maxlen)
+
+    def spawn_shell_cmd(self, cmd):
+        '''
+        Starts a long running shell command and returns its Popen without
+        waiting for it, e.g. a server that lives as long as the adb process
+        adb shell <cmd>
+        '''
+        if not isinstance(cmd, list):
+            cmd = cmd.split()
+        return subprocess.Popen(self.__build_command__(['shell'] + cmd),
+                                stdin=subprocess.DEVNULL,
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL,
+                                shell=False)
+
     def get_version(self):
         '''
         Returns ADB tool version
@@ -383,7 +813,7 @@ class ADB():
 
     def get_logcat(self, lcfilter=""):
         '''
-        View device log
+        View device log (see stream() to follow it)
         adb logcat <filter>
         '''
         self.__clean__()
@@ -509,17 +939,111 @@ class ADB():
 
         return self.__output
 
-adb = ADB()
-
-def bind_rpycs():
+class ForwardManager():
+    '''
+    Port forwards of every device, read once from `adb forward --list` and
+    kept per serial. ensure() only asks adb for the forwards that are
+    missing; invalidate() when the device (or the adb server) comes back.
+    '''
+
+    def __init__(self, adb, attempts=3, timeout=10):
+        self.adb = adb
+        self.attempts = attempts
+        self.timeout = timeout
+        self.__table = None
+        self.__lock = threading.Lock()
+
+    def refresh(self):
+        table = {}
+        for line in (self.adb.run_sync(['forward', '--list']).output or b'').decode('utf-8', 'replace').splitlines():
+            fwd = line.split()
+            if len(fwd) == 3:
+                table.setdefault(fwd[0], {})[fwd[1]] = fwd[2]
+        self.__table = table
+        return table
+
+    def invalidate(self):
+        self.__table = None
+
+    def serial(self):
+        serial = self.adb.get_target_device()
+        if serial is None:
+            serial = (self.adb.run_sync(['get-serialno']).output or b'').decode('utf-8', 'replace').strip()
+        return serial
+
+    def forwards(self, serial=None):
+        with self.__lock:
+            table = self.__table if self.__table is not None else self.refresh()
+            return dict(table.get(serial or self.serial(), {}))
+
+    def ensure(self, forwards):
+        '''
+        Forward every (local, remote) of forwards that is not forwarded yet,
+        returns the ones that were missing.
+        '''
+        with self.__lock:
+            table = self.__table if self.__table is not None else self.refresh()
+            serial = self.serial()
+            active = table.setdefault(serial, {})
+            missing = [(local, remote) for local, remote in forwards if active.get(local) != remote]
+            pending = missing
+            for i in range(self.attempts):
+                if not pending:
+                    break
+                results = adb_loop.run(self.__forward(pending))
+                for (local, remote), result in zip(pending, results):
+                    if isinstance(result, AdbResult) and not result.failed:
+                        active[local] = remote
+                pending = [fwd for fwd in pending if active.get(fwd[0]) != fwd[1]]
+            return missing
+
+    async def __forward(self, forwards):
+        # all at once, each is a round-trip to the adb server
+        return await asyncio.gather(*[self.adb.run(['forward', local, remote], self.timeout)
+                                      for local, remote in forwards], return_exceptions=True)
+
+
+RPYC_FORWARDS = DEFAULT_PORTS.forwards()
+
+# serial -> (ADB, ForwardManager), None is the default (first) board;
+# created on first use, importing this module must not talk to adb
+_devices = {}
+_devices_lock = threading.Lock()
+
+
+def get_device(serial=None):
+    '''
+    ADB and ForwardManager of the board with serial, the default (first)
+    board for None
+    '''
+    with _devices_lock:
+        if serial not in _devices:
+            device = ADB(device=serial, shell_session=True, backend='socket')
+            _devices[serial] = (device, ForwardManager(device))
+        return _devices[serial]
+
+
+def get_adb():
+    return get_device()[0]
+
+
+def bind_rpycs(ports=DEFAULT_PORTS):
     # return
-    global adb
+    adb, forwards = get_device(ports.serial)
+    health = HealthChecker('localhost', ports)
+    # the forwarded ports answer, no need to ask the board
+    if health.ok():
+        return True
     # for item in adb.devices:
     #     print(item)
     # if adb.check_root():
     #     print("I'm root.")
     if(adb.connect_check()):
         import time
+        # only the forwards were gone (adb server restarted)
+        if forwards.ensure(ports.forwards()) and health.ok():
+            return True
+        # fall back to looking for the server process
         for i in range(3):
             adb.run_shell_cmd("ps | grep 'from maix import mjpg;mjpg.start();' | awk '{print $1}'")
             res = adb.get_output()
@@ -537,16 +1061,9 @@ def bind_rpycs():
         adb.run_shell_cmd('/etc/init.d/S52ntpd stop')
         adb.run_shell_cmd("ps | grep python | awk '{print $1}' | xargs kill -9")
         # ----
-        adb.forward_socket('tcp:18811', 'tcp:18811')
-        adb.forward_socket('tcp:18811', 'tcp:18811')
-        adb.forward_socket('tcp:18811', 'tcp:18811')
-        adb.forward_socket('tcp:18812', 'tcp:18812')
-        adb.forward_socket('tcp:18812', 'tcp:18812')
-        adb.forward_socket('tcp:18812', 'tcp:18812')
-        adb.forward_socket('tcp:22', 'tcp:22')
-        adb.forward_socket('tcp:22', 'tcp:22')
-        adb.forward_socket('tcp:22', 'tcp:22')
-        adb.run_shell_cmd("python -c 'from maix import mjpg;mjpg.start();'")
+        forwards.ensure(ports.forwards())
+        # the server lives as long as this adb process, do not wait for it
+        adb.spawn_shell_cmd("python -c 'from maix import mjpg;mjpg.start();'")
         # adb.run_shell_cmd('/etc/init.d/S40network stop')
         # print(adb.get_output().decode())
         # adb.run_shell_cmd('killall tcpsvd')
@@ -568,7 +1085,6 @@ if __name__ == "__main__":
     # adb.run_shell_cmd('/etc/init.d/S52ntpd stop')
     # adb.run_shell_cmd("ps | grep python | awk '{print $1}' | xargs kill -9")
     # # ----
-    adb.forward_socket('tcp:18811', 'tcp:18811')
-    adb.forward_socket('tcp:18812', 'tcp:18812')
+    get_device()[1].ensure(RPYC_FORWARDS[:2])
     # while True:
     #     print('bind_rpycs()', bind_rpycs())
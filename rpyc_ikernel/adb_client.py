@@ -0,0 +1,228 @@
+"""
+adb_client.py
+
+Minimal client for the adb host protocol, spoken directly to the adb
+server (localhost:5037) instead of running the adb binary per command.
+
+Requests are a 4 digit hex length followed by the service name; the server
+answers OKAY or FAIL (followed by a hex length prefixed message).
+
+"""
+
+import os
+import socket
+import struct
+import time
+
+ADB_HOST = '127.0.0.1'
+ADB_PORT = 5037
+
+SYNC_DATA_MAX = 64 * 1024
+
+
+class AdbError(Exception):
+    pass
+
+
+class AdbServerError(AdbError):
+    '''
+    The adb server is not reachable (not started yet?)
+    '''
+    pass
+
+
+class AdbClient():
+
+    def __init__(self, host=ADB_HOST, port=None, timeout=10):
+        self.host = host
+        # same override the adb binary honours
+        self.port = port or int(os.environ.get('ANDROID_ADB_SERVER_PORT', ADB_PORT))
+        self.timeout = timeout
+
+    def connect(self):
+        try:
+            return socket.create_connection((self.host, self.port), timeout=self.timeout)
+        except OSError as e:
+            raise AdbServerError('cannot connect to adb server %s:%d (%s)' % (self.host, self.port, e))
+
+    @staticmethod
+    def _recv_exact(sock, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise AdbError('connection closed by adb server')
+            data += chunk
+        return bytes(data)
+
+    @staticmethod
+    def _recv_all(sock):
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+    def _read_string(self, sock):
+        return self._recv_exact(sock, int(self._recv_exact(sock, 4), 16))
+
+    def _request(self, sock, service):
+        if isinstance(service, str):
+            service = service.encode('utf-8')
+        sock.sendall(b'%04x' % len(service) + service)
+        status = self._recv_exact(sock, 4)
+        if status == b'FAIL':
+            raise AdbError(self._read_string(sock).decode('utf-8', 'replace'))
+        if status != b'OKAY':
+            raise AdbError('unexpected adb status %r' % status)
+
+    def _transport(self, sock, serial=None):
+        self._request(sock, 'host:transport:%s' % serial if serial else 'host:transport-any')
+
+    @staticmethod
+    def _host(serial):
+        return 'host-serial:%s' % serial if serial else 'host'
+
+    def _service(self, serial, service):
+        sock = self.connect()
+        try:
+            self._transport(sock, serial)
+            self._request(sock, service)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def query(self, service):
+        '''
+        host service answering with one length prefixed string
+        '''
+        with self.connect() as sock:
+            self._request(sock, service)
+            return self._read_string(sock)
+
+    def command(self, service):
+        '''
+        host service answering with OKAY only
+        '''
+        with self.connect() as sock:
+            self._request(sock, service)
+            # forward answers OKAY twice (transport, then forward), a FAIL may follow the first
+            rest = self._recv_all(sock)
+            if rest.startswith(b'FAIL'):
+                raise AdbError(rest[8:].decode('utf-8', 'replace'))
+            return rest[4:] if rest.startswith(b'OKAY') else rest
+
+    def version(self):
+        return int(self.query('host:version'), 16)
+
+    def devices(self):
+        '''
+        [[serial, state, details...], ...]  adb devices -l
+        '''
+        return self._parse_devices(self.query('host:devices-l'))
+
+    @staticmethod
+    def _parse_devices(data):
+        return [line.split() for line in data.decode('utf-8').splitlines() if line.strip()]
+
+    def track_devices(self):
+        '''
+        Socket the server writes the device list to on every change, read
+        the lists off it with read_devices
+        '''
+        sock = self.connect()
+        try:
+            self._request(sock, 'host:track-devices-l')
+        except Exception:
+            sock.close()
+            raise
+        sock.settimeout(None)
+        return sock
+
+    def read_devices(self, sock):
+        return self._parse_devices(self._read_string(sock))
+
+    def get_state(self, serial=None):
+        return self.query('%s:get-state' % self._host(serial)).decode('utf-8')
+
+    def get_serialno(self, serial=None):
+        return self.query('%s:get-serialno' % self._host(serial)).decode('utf-8')
+
+    def forward(self, local, remote, serial=None, norebind=False):
+        self.command('%s:forward:%s%s;%s' % (self._host(serial), 'norebind:' if norebind else '', local, remote))
+
+    def list_forward(self):
+        '''
+        [(serial, local, remote), ...]  adb forward --list
+        '''
+        lines = self.query('host:list-forward').decode('utf-8').splitlines()
+        return [tuple(line.split()) for line in lines if len(line.split()) == 3]
+
+    def kill_server(self):
+        try:
+            self.command('host:kill')
+        except AdbError:
+            pass
+
+    def shell(self, cmd, serial=None, timeout=None):
+        '''
+        Output of cmd run through the device shell, shell:<cmd>; a quiet
+        command is waited for up to timeout seconds between two reads
+        (None: as long as it runs, like adb shell)
+        '''
+        sock = self._service(serial, 'shell:%s' % cmd)
+        with sock:
+            sock.settimeout(timeout)
+            return self._recv_all(sock)
+
+    def open_shell(self, cmd, serial=None):
+        '''
+        Socket streaming the output of a long running shell command
+        '''
+        return self._service(serial, 'shell:%s' % cmd)
+
+    # sync: service, ids and lengths are little endian 32 bit
+
+    @staticmethod
+    def _sync_send(sock, sid, data):
+        sock.sendall(sid + struct.pack('<I', len(data)) + data)
+
+    def _sync_recv(self, sock):
+        header = self._recv_exact(sock, 8)
+        return header[:4], struct.unpack('<I', header[4:])[0]
+
+    def push(self, local, remote, serial=None, mode=0o644):
+        sock = self._service(serial, 'sync:')
+        with sock, open(local, 'rb') as f:
+            self._sync_send(sock, b'SEND', ('%s,%d' % (remote, mode)).encode('utf-8'))
+            while True:
+                chunk = f.read(SYNC_DATA_MAX)
+                if not chunk:
+                    break
+                self._sync_send(sock, b'DATA', chunk)
+            sock.sendall(b'DONE' + struct.pack('<I', int(os.path.getmtime(local) or time.time())))
+            sid, length = self._sync_recv(sock)
+            if sid == b'FAIL':
+                raise AdbError(self._recv_exact(sock, length).decode('utf-8', 'replace'))
+            self._sync_send(sock, b'QUIT', b'')
+
+    def pull(self, remote, local, serial=None):
+        sock = self._service(serial, 'sync:')
+        size = 0
+        with sock, open(local, 'wb') as f:
+            self._sync_send(sock, b'RECV', remote.encode('utf-8'))
+            while True:
+                sid, length = self._sync_recv(sock)
+                if sid == b'DATA':
+                    f.write(self._recv_exact(sock, length))
+                    size += length
+                elif sid == b'DONE':
+                    break
+                elif sid == b'FAIL':
+                    raise AdbError(self._recv_exact(sock, length).decode('utf-8', 'replace'))
+                else:
+                    raise AdbError('unexpected sync id %r' % sid)
+            self._sync_send(sock, b'QUIT', b'')
+        return size
@@ -0,0 +1,207 @@
+"""
+connection.py
+
+rpyc connections to the board that outlive a single cell.
+
+"""
+
+import logging
+import queue
+import threading
+import time
+
+RPYC_PORT = 18812
+
+
+def open_connection(endpoint, timeout=3.0):
+    '''
+    rpyc classic connection to endpoint, (host, port).
+    '''
+    import rpyc
+    host, port = endpoint
+    # one connect with its own timeout, rpyc's default retries a silent host six times;
+    # small requests back to back (stdio, pings), do not let Nagle hold them
+    return rpyc.classic.connect_stream(
+        rpyc.SocketStream.connect(host, port, timeout=timeout, nodelay=True, attempts=1))
+
+
+def race_connect(endpoints, stagger=0.25, timeout=3.0, connect=open_connection):
+    '''
+    Happy eyeballs over endpoints, [(host, port), ...] in order of
+    preference: the next attempt starts stagger seconds after the previous
+    one (at once when it failed), the first connection wins and the ones
+    completing later are closed. Returns (conn, endpoint), raises
+    ConnectionError with every failure when none answers.
+    '''
+    endpoints = list(endpoints)
+    if not endpoints:
+        raise ConnectionError('no endpoint to connect to')
+    results = queue.Queue()
+    lock = threading.Lock()
+    won = []
+
+    def attempt(endpoint):
+        try:
+            conn = connect(endpoint, timeout)
+        except Exception as e:
+            results.put((endpoint, None, e))
+            return
+        with lock:
+            lost = bool(won)
+            won.append(endpoint)
+        if lost:
+            conn.close()
+        else:
+            results.put((endpoint, conn, None))
+
+    pending, running, errors = list(endpoints), 0, []
+    deadline = time.monotonic() + timeout + stagger * len(endpoints)
+    while pending or running:
+        if pending:
+            threading.Thread(target=attempt, args=(pending.pop(0), ), name='RaceConnect', daemon=True).start()
+            running += 1
+        wait = stagger if pending else deadline - time.monotonic()
+        try:
+            endpoint, conn, error = results.get(timeout=max(wait, 0))
+        except queue.Empty:
+            if pending:
+                continue
+            break
+        running -= 1
+        if conn is not None:
+            return conn, endpoint
+        errors.append('%s:%d %r' % (endpoint[0], endpoint[1], error))
+    with lock:
+        # an attempt finishing after we gave up closes its own connection
+        won.append(None)
+    raise ConnectionError('no endpoint answered: %s' % ', '.join(errors or ['timeout']))
+
+
+class ConnectionPool():
+    '''
+    Named rpyc connections to one board: 'exec' runs the cells, 'control'
+    does cleanup, interrupts and display clearing. Connections are checked
+    before they are handed out (closed, or a ping once they have been idle
+    for check_interval seconds) and reopened when they fail.
+
+    address is a host or a list of candidates reaching the same board, hosts
+    (on port) or (host, port) pairs. The candidates are raced with
+    race_connect and the endpoint that won goes first the next time.
+
+    on_connect(name, conn) is called for every connection opened.
+    '''
+
+    def __init__(self, address='localhost', port=RPYC_PORT, check_interval=5.0, ping_timeout=3.0,
+                 stagger=0.25, connect_timeout=3.0, on_connect=None, log=None):
+        self._address = address
+        self._port = port
+        self.check_interval = check_interval
+        self.ping_timeout = ping_timeout
+        self.stagger = stagger
+        self.connect_timeout = connect_timeout
+        self.on_connect = on_connect
+        self.log = log or logging.getLogger("rpyc_ikernel")
+        self.winner = None
+        self._conns = {}
+        self._used = {}
+        self._lock = threading.RLock()
+
+    @property
+    def address(self):
+        '''
+        Host of the endpoint that answered last, the first candidate before that.
+        '''
+        return (self.winner or self.endpoints()[0])[0]
+
+    @address.setter
+    def address(self, address):
+        if address != self._address:
+            self.close()
+            self.winner = None
+        self._address = address
+
+    @property
+    def candidates(self):
+        return self._address
+
+    @property
+    def port(self):
+        return self._port
+
+    @port.setter
+    def port(self, port):
+        if port != self._port:
+            self.close()
+            self.winner = None
+        self._port = port
+
+    def endpoints(self):
+        '''
+        [(host, port), ...] to try, the last winner first.
+        '''
+        candidates = self._address if isinstance(self._address, (list, tuple)) else [self._address]
+        endpoints = [tuple(c) if isinstance(c, (list, tuple)) else (c, self._port) for c in candidates]
+        if self.winner in endpoints:
+            endpoints.remove(self.winner)
+            endpoints.insert(0, self.winner)
+        return endpoints
+
+    def connect(self, name):
+        '''
+        Open a fresh connection for name, replacing the pooled one.
+        '''
+        with self._lock:
+            self.drop(name)
+            endpoints = self.endpoints()
+            if len(endpoints) == 1:
+                conn, self.winner = open_connection(endpoints[0], self.connect_timeout), endpoints[0]
+            else:
+                conn, self.winner = race_connect(endpoints, self.stagger, self.connect_timeout)
+                self.log.debug('[%s] %s connected via %s:%d' % (self.address, name, self.winner[0], self.winner[1]))
+            if self.on_connect:
+                self.on_connect(name, conn)
+            self._conns[name] = conn
+            self._used[name] = time.monotonic()
+            return conn
+
+    def healthy(self, name):
+        with self._lock:
+            conn = self._conns.get(name)
+            if conn is None or conn.closed:
+                return False
+            if time.monotonic() - self._used[name] < self.check_interval:
+                return True
+            try:
+                conn.ping(timeout=self.ping_timeout)
+            except Exception as e:
+                self.log.debug('[%s] %s ping %s' % (self.address, name, repr(e)))
+                return False
+            self._used[name] = time.monotonic()
+            return True
+
+    def get(self, name):
+        '''
+        The pooled connection for name, reconnecting if it is not healthy.
+        '''
+        with self._lock:
+            if self.healthy(name):
+                self._used[name] = time.monotonic()
+                return self._conns[name]
+            return self.connect(name)
+
+    def peek(self, name):
+        return self._conns.get(name)
+
+    def drop(self, name):
+        with self._lock:
+            conn = self._conns.pop(name, None)
+            self._used.pop(name, None)
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception as e:
+                self.log.debug('[%s] %s close %s' % (self.address, name, repr(e)))
+
+    def close(self):
+        for name in list(self._conns):
+            self.drop(name)
@@ -0,0 +1,72 @@
+"""
+devices.py
+
+Host ports for every board, so several boards (and the kernels driving
+them) can share one workstation.
+
+"""
+
+from collections import namedtuple
+
+from .jsonfile import JsonFile, data_path
+
+# board side, the same on every board
+MJPG_PORT, RPYC_PORT, SSH_PORT = 18811, 18812, 22
+
+DEVICE_ENV = 'RPYC_IKERNEL_DEVICE'
+
+
+class DevicePorts(namedtuple('DevicePorts', 'serial mjpg rpyc ssh')):
+
+    def forwards(self):
+        '''
+        (local, remote) adb forwards for this board
+        '''
+        return (('tcp:%d' % self.mjpg, 'tcp:%d' % MJPG_PORT),
+                ('tcp:%d' % self.rpyc, 'tcp:%d' % RPYC_PORT),
+                ('tcp:%d' % self.ssh, 'tcp:%d' % SSH_PORT))
+
+
+DEFAULT_PORTS = DevicePorts(None, MJPG_PORT, RPYC_PORT, SSH_PORT)
+
+
+class DeviceRegistry():
+    '''
+    Maps a device serial to a slot, kept in a json file shared by all
+    kernels of the user. Slot 0 is the classic 18811/18812/22 of the
+    kernels not pinned to a board (DEFAULT_PORTS), serials start at
+    slot 1; slot n forwards 18811+10n, 18812+10n and 18813+10n to the
+    board's 18811, 18812 and 22.
+    '''
+
+    def __init__(self, path=None, step=10):
+        self.file = JsonFile(path or data_path('devices.json'))
+        self.step = step
+
+    def _ports(self, serial, slot):
+        if slot == 0:
+            return DevicePorts(serial, MJPG_PORT, RPYC_PORT, SSH_PORT)
+        base = MJPG_PORT + self.step * slot
+        return DevicePorts(serial, base, base + 1, base + 2)
+
+    def ports(self, serial):
+        '''
+        DevicePorts of serial, a free slot is assigned on first use.
+        '''
+        with self.file.locked():
+            slots = self.file.load()
+            # files written before slot 0 was reserved may hand it to a serial
+            if not slots.get(serial):
+                used = set(slots.values())
+                slots[serial] = next(slot for slot in range(1, len(used) + 2) if slot not in used)
+                self.file.save(slots)
+            return self._ports(serial, slots[serial])
+
+    def devices(self):
+        return [self._ports(serial, slot) for serial, slot in sorted(self.file.load().items(), key=lambda item: item[1])]
+
+    def release(self, serial):
+        with self.file.locked():
+            slots = self.file.load()
+            if slots.pop(serial, None) is not None:
+                self.file.save(slots)
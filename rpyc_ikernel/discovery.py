@@ -0,0 +1,146 @@
+"""
+discovery.py
+
+Finds MaixPy3 rpyc servers on the local network, so a board can be used
+without knowing its IP.
+
+Boards registered with an rpyc registry (rpyc_registry.py, the servers'
+auto_register) answer a UDP broadcast query; boards seen before are kept
+in a json file and probed again even when no registry answers.
+
+"""
+
+import threading
+import time
+from collections import namedtuple
+
+from .devices import RPYC_PORT
+from .health import rpyc_rtt
+from .jsonfile import JsonFile, data_path
+
+REGISTRY_PORT = 18811  # rpyc.utils.registry.REGISTRY_PORT, UDP
+BROADCAST = '255.255.255.255'
+
+
+class Endpoint(namedtuple('Endpoint', 'host port rtt last_seen')):
+
+    @property
+    def reachable(self):
+        return self.rtt is not None
+
+
+class EndpointCache():
+    '''
+    Boards seen on the network, "host:port" -> {'last_seen': time, 'rtt':
+    seconds}, in a json file shared by all kernels of the user. Entries
+    not seen for max_age seconds are forgotten.
+    '''
+
+    def __init__(self, path=None, max_age=7 * 24 * 3600):
+        self.file = JsonFile(path or data_path('endpoints.json'))
+        self.max_age = max_age
+
+    @staticmethod
+    def _key(host, port):
+        return '%s:%d' % (host, port)
+
+    def endpoints(self):
+        '''
+        [Endpoint, ...] of the cache, most recently seen first.
+        '''
+        now = time.time()
+        found = []
+        for key, entry in self.file.load().items():
+            if now - entry.get('last_seen', 0) > self.max_age:
+                continue
+            host, port = key.rsplit(':', 1)
+            found.append(Endpoint(host, int(port), entry.get('rtt'), entry.get('last_seen')))
+        return sorted(found, key=lambda e: -e.last_seen)
+
+    def update(self, endpoints):
+        '''
+        Record the reachable ones of endpoints.
+        '''
+        with self.file.locked():
+            entries = self.file.load()
+            now = time.time()
+            for e in endpoints:
+                if e.reachable:
+                    entries[self._key(e.host, e.port)] = {'last_seen': e.last_seen, 'rtt': e.rtt}
+            self.file.save({k: v for k, v in entries.items() if now - v.get('last_seen', 0) <= self.max_age})
+
+    def forget(self, host, port=RPYC_PORT):
+        with self.file.locked():
+            entries = self.file.load()
+            if entries.pop(self._key(host, port), None) is not None:
+                self.file.save(entries)
+
+
+def query_registry(host=BROADCAST, port=REGISTRY_PORT, service='SLAVE', timeout=1.0):
+    '''
+    ((host, port), ...) the rpyc registries reachable at host know for
+    service, the classic servers register as SLAVE.
+    '''
+    from rpyc.utils.registry import UDPRegistryClient
+    try:
+        return tuple(tuple(addr) for addr in UDPRegistryClient(host, port, timeout=timeout).discover(service))
+    except OSError:
+        # no route for the broadcast, no network at all
+        return ()
+
+
+class Discovery():
+    '''
+    Candidates are what the registry answers, the cached boards and hosts
+    given by the caller; all of them are probed in parallel with an rpyc
+    ping and the ones answering are cached with their round-trip.
+    '''
+
+    def __init__(self, registry=BROADCAST, registry_port=REGISTRY_PORT, service='SLAVE',
+                 timeout=1.0, cache=None):
+        self.registry = registry
+        self.registry_port = registry_port
+        self.service = service
+        self.timeout = timeout
+        self.cache = cache if cache is not None else EndpointCache()
+
+    def candidates(self, hosts=()):
+        found = [tuple(h) if isinstance(h, (list, tuple)) else (h, RPYC_PORT) for h in hosts]
+        if self.registry:
+            found += query_registry(self.registry, self.registry_port, self.service, self.timeout)
+        found += [(e.host, e.port) for e in self.cache.endpoints()]
+        # keep the first of duplicates
+        return list(dict.fromkeys(found))
+
+    def probe(self, endpoints):
+        '''
+        [Endpoint, ...] of endpoints, rtt is None for the silent ones.
+        '''
+        results = [None] * len(endpoints)
+
+        def run(i, host, port):
+            rtt = rpyc_rtt(host, port, self.timeout)
+            results[i] = Endpoint(host, port, rtt, time.time() if rtt is not None else None)
+
+        threads = [threading.Thread(target=run, args=(i, host, port), name='DiscoveryProbe', daemon=True)
+                   for i, (host, port) in enumerate(endpoints)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def discover(self, hosts=()):
+        '''
+        [Endpoint, ...] of every candidate, reachable ones first by round-trip.
+        '''
+        found = self.probe(self.candidates(hosts))
+        self.cache.update(found)
+        return sorted(found, key=lambda e: (not e.reachable, e.rtt or 0))
+
+    def best(self, hosts=()):
+        '''
+        The reachable Endpoint with the lowest round-trip, None if none answers.
+        '''
+        found = self.discover(hosts)
+        return found[0] if found and found[0].reachable else None
@@ -0,0 +1,280 @@
+"""
+display.py
+
+Host side plumbing for the MJPEG preview that is shown under a running cell.
+
+"""
+
+import collections
+import concurrent.futures
+import io
+import logging
+import multiprocessing
+import os
+import random
+import threading
+
+from .mjpg import BufferPool, MjpgReader
+
+
+class FrameSlot():
+    '''
+    Single slot "latest frame wins" buffer shared by the stream reader and the
+    iopub publisher. The reader overwrites the slot as fast as frames arrive,
+    the publisher always takes the newest one, anything it did not get to in
+    time is counted as dropped and handed to release, if given. totals, a
+    Counter shared by the slots of a kernel, gets the same counts so they
+    add up across cells.
+    '''
+
+    def __init__(self, release=None, totals=None):
+        self._cond = threading.Condition()
+        self._release = release
+        self._totals = totals if totals is not None else collections.Counter()
+        self._frame = None
+        self._closed = False
+        self.received = 0
+        self.published = 0
+        self.dropped = 0
+
+    def put(self, frame):
+        with self._cond:
+            if self._frame is not None:
+                self.dropped += 1
+                self._totals['dropped'] += 1
+                if self._release:
+                    self._release(self._frame)
+            self._frame = frame
+            self.received += 1
+            self._totals['received'] += 1
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        '''
+        Wait for a frame and take it out of the slot, returns None on timeout
+        or once the slot has been closed.
+        '''
+        with self._cond:
+            if self._frame is None and not self._closed:
+                self._cond.wait(timeout)
+            frame, self._frame = self._frame, None
+            if frame is not None:
+                self.published += 1
+                self._totals['published'] += 1
+            return frame
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def stats(self):
+        return {
+            'received': self.received,
+            'published': self.published,
+            'dropped': self.dropped,
+        }
+
+
+class DisplaySession():
+    '''
+    Long lived MJPEG connection owned by the kernel. One reader thread keeps
+    the stream to the device open across cells, reconnecting with exponential
+    backoff and jitter when it drops; a cell only attaches the FrameSlot its
+    publisher reads from and detaches it when it ends. Frames arriving while
+    no cell is attached go straight back to the pool.
+    '''
+
+    def __init__(self, url, pool=None, backoff=0.2, max_backoff=10.0, timeout=9, log=None):
+        self.url = url
+        self.pool = pool if pool is not None else BufferPool()
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.log = log or logging.getLogger("rpyc_ikernel")
+        self.connects = 0
+        self.failures = 0
+        # off the stream, attached to a cell or not
+        self.frames = 0
+        self.bytes = 0
+        self._slot = None
+        self._client = None
+        # grows with every failed connect or stream, back to backoff once a frame came through
+        self._delay = backoff
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='DisplaySession', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def attach(self, slot):
+        self._slot = slot
+
+    def detach(self):
+        slot, self._slot = self._slot, None
+        if slot:
+            slot.close()
+
+    def close(self):
+        self._closed.set()
+        self.detach()
+        client, self._client = self._client, None
+        if client:
+            try:
+                client.close()
+            except Exception as e:
+                self.log.debug('[%s] close %s' % (self.url, e))
+
+    @property
+    def closed(self):
+        return self._closed.is_set()
+
+    @property
+    def connected(self):
+        return self._client is not None
+
+    def _wait(self):
+        # full jitter keeps several kernels from hammering a rebooting board in step
+        self._closed.wait(self._delay * (0.5 + random.random()))
+        self._delay = min(self._delay * 2, self.max_backoff)
+
+    def _connect(self):
+        while not self.closed:
+            try:
+                self._client = MjpgReader(self.url, timeout=self.timeout, pool=self.pool)
+                self.connects += 1
+                self.log.debug('[%s] connect... (%s)' % (self.url, self.connects))
+                return True
+            except Exception as e:
+                self.failures += 1
+                self.log.debug('[%s] connect %s, retry in %.2fs' % (self.url, e, self._delay))
+            self._wait()
+        return False
+
+    def _run(self):
+        while not self.closed:
+            if self._client is None and not self._connect():
+                break
+            client = self._client
+            try:
+                for frame in client.iter_content():
+                    self._delay = self.backoff
+                    self.frames += 1
+                    self.bytes += len(frame)
+                    slot = self._slot
+                    if slot is not None and not slot.closed:
+                        slot.put(frame)
+                    else:
+                        self.pool.release(frame)
+                    if self.closed or client is not self._client:
+                        break
+            except Exception as e:
+                self.failures += 1
+                self.log.debug('[%s] stream %s, reconnect in %.2fs' % (self.url, e, self._delay))
+                if self._client is client:
+                    self._client = None
+                try:
+                    client.close()
+                except Exception:
+                    pass
+                # a server that hangs up right after the headers must not be reconnected in a loop
+                self._wait()
+
+
+# what imghdr.what() told apart for us, imghdr is gone from Python 3.13
+_IMAGE_MAGIC = (
+    (b'\xff\xd8', 'jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'BM', 'bmp'),
+)
+
+
+def image_type(data):
+    '''
+    Image type of data from its first bytes, 'jpeg' when unknown (the
+    mjpg server only sends JPEG).
+    '''
+    head = bytes(data[:12])
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    for magic, kind in _IMAGE_MAGIC:
+        if head.startswith(magic):
+            return kind
+    return 'jpeg'
+
+
+def transform_frame(data, max_width=None, quality=75):
+    '''
+    Downscale a JPEG to max_width (keeping its aspect) and re-encode it at the
+    given quality. Runs in a FrameTransform worker process.
+    '''
+    from PIL import Image
+    img = Image.open(io.BytesIO(data))
+    if max_width and img.width > max_width:
+        img = img.resize((max_width, max(1, img.height * max_width // img.width)))
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    out = io.BytesIO()
+    img.save(out, format='JPEG', quality=quality)
+    return out.getvalue()
+
+
+class FrameTransform():
+    '''
+    Host side resize/re-encode stage, kept in a process pool so neither the
+    stream reader nor the kernel are held up by PIL.
+    '''
+
+    def __init__(self, max_width=None, quality=75, workers=None):
+        self.max_width = max_width
+        self.quality = quality
+        # spawn, forking the threaded kernel process is not safe
+        self._pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers or min(2, os.cpu_count() or 1),
+            mp_context=multiprocessing.get_context('spawn'))
+
+    def submit(self, data):
+        return self._pool.submit(transform_frame, bytes(data), self.max_width, self.quality)
+
+    def __call__(self, data, timeout=None):
+        return self.submit(data).result(timeout)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
+
+
+FRAME_COMM_TARGET = 'rpyc_ikernel.frames'
+
+# Runs once in the (classic) notebook page: opens the frame comm back to the
+# kernel and paints every raw JPEG buffer into the <img> of its display_id.
+FRAME_RENDERER_JS = '''
+(function () {
+    var kernel = (window.Jupyter && Jupyter.notebook) ? Jupyter.notebook.kernel : null;
+    if (!kernel) { return; }
+    var comm = kernel.comm_manager.new_comm('%s', {});
+    comm.on_msg(function (msg) {
+        var data = msg.content.data, buffers = msg.buffers || [];
+        if (!buffers.length) { return; }
+        var url = URL.createObjectURL(new Blob([buffers[0]], {type: data.mimetype}));
+        var imgs = document.querySelectorAll('img[data-rpyc-frame="' + data.display_id + '"]');
+        for (var i = 0; i < imgs.length; i++) {
+            if (imgs[i].src.indexOf('blob:') === 0) { URL.revokeObjectURL(imgs[i].src); }
+            imgs[i].src = url;
+        }
+    });
+})();
+''' % FRAME_COMM_TARGET
+
+
+def frame_placeholder(display_id):
+    '''
+    Output the frame comm renders into, published once per cell.
+    '''
+    return '<img data-rpyc-frame="%s"/>' % display_id
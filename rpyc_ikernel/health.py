@@ -0,0 +1,102 @@
+"""
+health.py
+
+Is the board serving? Answered with local sockets on the forwarded ports,
+instead of `ps | grep` through adb shell.
+
+"""
+
+import socket
+import time
+
+from .devices import DEFAULT_PORTS
+
+
+def probe_tcp(host, port, timeout=0.3, grace=0.05):
+    '''
+    Is something serving host:port? A forwarded port accepts the connection
+    on the host even when nothing listens on the board, adb then closes it
+    within grace seconds; a live server waits for us to talk first.
+    '''
+    try:
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            sock.settimeout(grace)
+            try:
+                return sock.recv(1) != b''
+            except socket.timeout:
+                return True
+    except OSError:
+        return False
+
+
+def probe_http(host, port, timeout=0.5):
+    '''
+    HEAD / answered with any HTTP status line (the mjpg server may not
+    implement HEAD, a 501 still means it is up).
+    '''
+    try:
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            sock.settimeout(timeout)
+            sock.sendall(b'HEAD / HTTP/1.0\r\nHost: %s\r\n\r\n' % host.encode())
+            return sock.recv(5) == b'HTTP/'
+    except OSError:
+        return False
+
+
+def rpyc_rtt(host, port, timeout=0.5):
+    '''
+    Round-trip of one rpyc ping in seconds after the handshake, None when
+    nothing answers.
+    '''
+    import rpyc
+    try:
+        stream = rpyc.SocketStream.connect(host, port, timeout=timeout, attempts=1)
+        conn = rpyc.connect_stream(stream, config={'sync_request_timeout': timeout})
+    except Exception:
+        return None
+    try:
+        start = time.perf_counter()
+        conn.ping(timeout=timeout)
+        return time.perf_counter() - start
+    except Exception:
+        return None
+    finally:
+        conn.close()
+
+
+def probe_rpyc(host, port, timeout=0.5):
+    '''
+    rpyc handshake and one ping.
+    '''
+    return rpyc_rtt(host, port, timeout) is not None
+
+
+class HealthChecker():
+    '''
+    Checks the board's services through its forwarded ports: mjpg answers
+    HTTP, rpyc answers a ping, one local round-trip each.
+    With deep=False only the TCP probe runs, it needs no cooperation from
+    the server but has to wait to see whether adb hangs up.
+    '''
+
+    def __init__(self, host='localhost', ports=DEFAULT_PORTS, timeout=0.5):
+        self.host = host
+        self.ports = ports
+        self.timeout = timeout
+
+    def check(self, deep=True):
+        '''
+        {'mjpg': bool, 'rpyc': bool}
+        '''
+        if not deep:
+            return {
+                'mjpg': probe_tcp(self.host, self.ports.mjpg, self.timeout),
+                'rpyc': probe_tcp(self.host, self.ports.rpyc, self.timeout),
+            }
+        return {
+            'mjpg': probe_http(self.host, self.ports.mjpg, self.timeout),
+            'rpyc': probe_rpyc(self.host, self.ports.rpyc, self.timeout),
+        }
+
+    def ok(self, deep=True):
+        return all(self.check(deep).values())
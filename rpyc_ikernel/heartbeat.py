@@ -0,0 +1,99 @@
+"""
+heartbeat.py
+
+Background liveness of the board, so the execute path reads a cached
+answer instead of pinging before every cell.
+
+"""
+
+import logging
+import time
+
+from .scheduler import Scheduler
+
+# seconds between two beats, $heartbeat(seconds) changes it at runtime
+HEARTBEAT_ENV = 'RPYC_IKERNEL_HEARTBEAT'
+
+
+class Heartbeat():
+    '''
+    Pings the pool's 'control' connection every interval seconds on a
+    Scheduler thread. The pool reopens the connection when it is gone, so
+    the beat also reconnects in the background. on_beat(alive) is called
+    after every beat.
+
+    state is 'unknown' before the first beat, then 'alive' or 'dead';
+    rtt is the round-trip of the last good ping in seconds.
+    '''
+
+    def __init__(self, pool, interval=2.0, timeout=1.0, on_beat=None, log=None):
+        self.pool = pool
+        self.interval = interval
+        self.timeout = timeout
+        self.on_beat = on_beat
+        self.log = log or logging.getLogger("rpyc_ikernel")
+        self.state = 'unknown'
+        self.rtt = None
+        self.last_beat = None
+        self.last_alive = None
+        self.beats = 0
+        self.failures = 0
+        self._scheduler = None
+
+    def start(self):
+        self._scheduler = Scheduler('recur', self.interval, self.beat)
+        self._scheduler.daemon = True
+        self._scheduler.start()
+        return self
+
+    def stop(self):
+        if self._scheduler:
+            self._scheduler.cancel()
+            self._scheduler = None
+
+    def set_interval(self, interval):
+        '''
+        Beat every interval seconds from now on, a running beat is restarted.
+        '''
+        self.interval = interval
+        if self._scheduler:
+            self.stop()
+            self.start()
+
+    def fresh(self):
+        '''
+        Is the state recent enough to act on (two intervals)?
+        '''
+        return self.last_beat is not None and time.monotonic() - self.last_beat < 2 * self.interval
+
+    @property
+    def alive(self):
+        return self.state == 'alive' and self.fresh()
+
+    @property
+    def dead(self):
+        return self.state == 'dead' and self.fresh()
+
+    def beat(self):
+        self.beats += 1
+        try:
+            conn = self.pool.get('control')
+            start = time.perf_counter()
+            conn.ping(timeout=self.timeout)
+            self.rtt = time.perf_counter() - start
+            self.last_alive = time.monotonic()
+            state = 'alive'
+        except Exception as e:
+            self.failures += 1
+            self.pool.drop('control')
+            state = 'dead'
+            if self.state != 'dead':
+                self.log.debug('[Heartbeat] %s %s' % (self.pool.address, repr(e)))
+        self.state, self.last_beat = state, time.monotonic()
+        if self.on_beat:
+            try:
+                self.on_beat(state == 'alive')
+            except Exception as e:
+                self.log.debug('[Heartbeat] on_beat %s' % repr(e))
+        # Scheduler keeps truthy return values, keep it from growing
+        return None
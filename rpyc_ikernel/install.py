@@ -1,5 +1,6 @@
 import json
 import os
+import re
 import sys
 import argparse
 
@@ -16,21 +17,27 @@ kernel_json = {
 }
 
 
-def install_my_kernel_spec(user=True, prefix=None):
+def install_my_kernel_spec(user=True, prefix=None, device=None):
     if "python2" in sys.executable:
         print("I think this needs python3")
+    spec, name = dict(kernel_json), 'RPyc'
+    if device:
+        # one kernel per board, see devices.DeviceRegistry
+        spec['display_name'] = '%s (%s)' % (kernel_json['display_name'], device)
+        spec['env'] = {'RPYC_IKERNEL_DEVICE': device}
+        name = 'RPyc-%s' % re.sub(r'[^A-Za-z0-9._-]', '_', device)
     with TemporaryDirectory() as td:
         os.chmod(td, 0o755)  # Starts off as 700, not user readable
         with open(os.path.join(td, 'kernel.json'), 'w') as f:
-            json.dump(kernel_json, f, sort_keys=True, indent=2)
+            json.dump(spec, f, sort_keys=True, indent=2)
         # TODO: Copy resources once they're specified
 
         print('Installing IPython kernel spec of RPyc')
         k = KernelSpecManager()
-        k.install_kernel_spec(td, 'RPyc', user=user,
+        k.install_kernel_spec(td, name, user=user,
                               replace=True, prefix=prefix)
 
-        h = k.get_kernel_spec("RPyc")
+        h = k.get_kernel_spec(name)
         print("...into", h.resource_dir)
 
 
@@ -64,6 +71,12 @@ def main(argv=None):
         default=None
     )
 
+    parser.add_argument(
+        '--device',
+        help='Bind the kernel to the adb device with this serial',
+        default=None
+    )
+
     args = parser.parse_args(argv)
 
     user = False
@@ -75,7 +88,7 @@ def main(argv=None):
     elif args.user or not _is_root():
         user = True
 
-    install_my_kernel_spec(user=user, prefix=prefix)
+    install_my_kernel_spec(user=user, prefix=prefix, device=args.device)
 
 
 if __name__ == '__main__':
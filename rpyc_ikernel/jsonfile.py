@@ -0,0 +1,73 @@
+"""
+jsonfile.py
+
+Small json files shared by all kernels of the user (the device slots, the
+boards seen on the network), read and rewritten under a file lock.
+
+"""
+
+import contextlib
+import json
+import os
+
+
+def data_path(name):
+    '''
+    name in the rpyc_ikernel directory of the jupyter data dir
+    '''
+    from jupyter_core.paths import jupyter_data_dir
+    return os.path.join(jupyter_data_dir(), 'rpyc_ikernel', name)
+
+
+try:
+    import fcntl
+
+    def _lock(f):
+        fcntl.flock(f, fcntl.LOCK_EX)
+
+    def _unlock(f):
+        fcntl.flock(f, fcntl.LOCK_UN)
+except ImportError:  # windows
+    import msvcrt
+
+    def _lock(f):
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+
+    def _unlock(f):
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class JsonFile():
+    '''
+    A json object in path. load() reads it ({} when missing or broken),
+    save() replaces it in one step, readers never see half of it; a
+    read-modify-save goes under locked(), kernels are separate processes.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self, data):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f, sort_keys=True, indent=2)
+        os.replace(tmp, self.path)
+
+    @contextlib.contextmanager
+    def locked(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path + '.lock', 'a+') as f:
+            _lock(f)
+            try:
+                yield
+            finally:
+                _unlock(f)
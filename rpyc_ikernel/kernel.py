@@ -8,52 +8,46 @@ job schedulers.
 
 """
 
-import imghdr
 import base64
 import os
 import logging
 import time
 import traceback
-import urllib.request
 import re
 import _thread
-import socket
-
-from PIL import Image # , UnidentifiedImageError
-import rpyc
-
-try:
-    from pexpect import spawn as pexpect_spawn
-except ImportError:
-    from pexpect.popen_spawn import PopenSpawn
-
-    class pexpect_spawn(PopenSpawn):
-        def isalive(self):
-            return self.proc.poll() is None
+import threading
+import uuid
+import collections
 
 # from .scheduler import Scheduler
 
-from .adb import bind_rpycs, adb
-
-def config_maixpy3():
-    from threading import Thread
-    import time
-    def tmp():
-        while True:
-          bind_rpycs()
-          time.sleep(1)
-    t = Thread(target=tmp,args=())
-    t.setDaemon(True)
-    t.start()
+# rpyc, urllib and PIL are imported where they are used, startup only pays for ipykernel
+from .adb import adb_stats, bind_rpycs, get_adb, get_device
+from .mjpg import BufferPool, ProtoError
+from .connection import ConnectionPool
+from .remote import install as install_remote
+from .display import DisplaySession, FrameSlot, FrameTransform, FRAME_COMM_TARGET, FRAME_RENDERER_JS, frame_placeholder, image_type
+from .watcher import DeviceWatcher
+from .health import HealthChecker
+from .devices import DeviceRegistry, DEFAULT_PORTS, DEVICE_ENV
+from .heartbeat import HEARTBEAT_ENV, Heartbeat
+from .discovery import Discovery
+from .stats import PhaseTimer
+from .profiler import RpycProfiler
+from .metrics import METRICS_ENV, Metrics, Sample, export as export_metrics
+
+def config_maixpy3(log=None, ports=DEFAULT_PORTS):
+    # binds the board over adb when it shows up or its services stop answering
+    # forwards go away with the device or the adb server, read them again
+    return DeviceWatcher(lambda: bind_rpycs(ports), serial=ports.serial, health=HealthChecker('localhost', ports),
+                         on_device=lambda present: get_device(ports.serial)[1].invalidate(),
+                         start_server=lambda: get_device(ports.serial)[0].start_server(), log=log).start()
 
 # from ipykernel.kernelbase import Kernel
 from ipykernel.ipkernel import IPythonKernel
 
 ########################################################################################################################################
 
-class ProtoError(Exception):
-    pass
-
 class MjpgSocket():
 
     def read_header_line(self, stream):
@@ -170,6 +164,7 @@ class MjpgSocket():
         return buf
 
     def unit_test(self):
+        import urllib.request
         try:
             url = "http://127.0.0.1:18811"
             with urllib.request.urlopen(url, timeout = 3) as stream:
@@ -183,6 +178,7 @@ class MjpgSocket():
             traceback.print_exc()
 
     def __init__(self, url: str):
+        import urllib.request
         self._url = url
         self.stream = urllib.request.urlopen(url, timeout = 9)
         self.boundary = self.open_mjpeg_stream(self.stream)
@@ -294,28 +290,6 @@ def _setup_logging(verbose=logging.INFO):
 
     return log
 
-# _async_raise(ident, SystemExit)
-
-
-def _async_raise(tid):
-    import inspect
-    import ctypes
-    exctype = KeyboardInterrupt
-    """raises the exception, performs cleanup if needed"""
-    tid = ctypes.c_long(tid)
-    if not inspect.isclass(exctype):
-        exctype = type(exctype)
-    res = ctypes.pythonapi.PyThreadState_SetAsyncExc(
-        tid, ctypes.py_object(exctype))
-    if res == 0:
-        return  # maybe thread killed
-        # raise ValueError("invalid thread id")
-    if res != 1:
-        # """if it returns a number greater than one, you're in trouble,
-        # and you should call it again with exc=NULL to revert the effect"""
-        ctypes.pythonapi.PyThreadState_SetAsyncExc(tid, None)
-        raise SystemError("PyThreadState_SetAsyncExc failed")
-
 
 class RPycKernel(IPythonKernel):
     implementation = 'rpyc_kernel'
@@ -329,42 +303,145 @@ class RPycKernel(IPythonKernel):
         IPythonKernel.__init__(self, **kwargs)
         self.log = _setup_logging()
         self.remote = None
-        self.address = "localhost"
+        # the board this kernel drives over adb, the kernelspec may pin it
+        serial = os.environ.get(DEVICE_ENV)
+        self.device = DeviceRegistry().ports(serial) if serial else DEFAULT_PORTS
+        self.channels = ConnectionPool("localhost", self.device.rpyc, log=self.log)
+        # liveness of the board, kept up to date off the execute path
+        self.heartbeat_interval = float(os.environ.get(HEARTBEAT_ENV) or 2.0)
+        self._exec_lock, self._executing = threading.Lock(), False
+        self._exec_ident = None
+        self._reaper, self._reaper_conn = None, None
         self.clear_output = True
+        self.update_display = True
+        self.frame_transport, self._frame_comm = 'base64', None
+        self.frame_transform = None
+        self._media_session, self._media_work, self._media_slot = None, False, None
+        self._media_pool = BufferPool()
         self.last_result = ""
+        self.wait_interval = 1
+        self.stdio_buffer, self.stdio_interval, self._stdio = 4096, 0.05, None
+        self.log_interval, self.log_lines, self._log_stream = 0.5, 20, None
+        self.discovery = Discovery()
+        # per cell phase timings, $stats() and the execute_reply metadata
+        self.timer = PhaseTimer()
+        # rpyc requests per cell, opt-in with $profile(True)
+        self.profiler, self.profiling = RpycProfiler(), False
+        self.channels.on_connect = self._on_channel
+        # counters for dashboards, exported with $metrics() or RPYC_IKERNEL_METRICS
+        self.metrics, self._metrics_export = Metrics(), None
+        self.metrics.add_collector(self._metric_samples)
+        self.frame_totals = collections.Counter()
+        self._count_iopub(self.session)
         # for do_handle
         self.pattern = re.compile("[$](.*?)[(](.*)[)]")
         self.commands = {
             'exec': '%s',
             'connect': 'self.connect_remote(%s)',
+            'transport': 'self.set_frame_transport(%s)',
+            'transform': 'self.set_frame_transform(%s)',
+            'device': 'self.set_device(%s)',
+            'log': 'self.attach_log(%s)',
+            'discover': 'self.discover_boards(%s)',
+            'stats': 'self.print_stats(%s)',
+            'profile': 'self.set_profile(%s)',
+            'metrics': 'self.set_metrics(%s)',
+            'heartbeat': 'self.set_heartbeat(%s)',
         }
-        config_maixpy3()
+        if getattr(self, 'comm_manager', None):
+            self.comm_manager.register_target(FRAME_COMM_TARGET, self._open_frame_comm)
+        self.watcher = config_maixpy3(self.log, self.device)
+        self.heartbeat = Heartbeat(self.channels, self.heartbeat_interval,
+                                   on_beat=self._background_reconnect, log=self.log).start()
+        if os.environ.get(METRICS_ENV):
+            self.set_metrics(os.environ[METRICS_ENV])
         # self.do_reconnect()
         # bind_rpycs()
 
         
-    def do_reconnect(self):
-        global adb
+    def _open_exec(self):
+        import sys
+        import rpyc
+        try:
+            remote = self.channels.connect('exec')
+            remote.modules.sys.stdin = sys.stdin
+            # prints on the board are shipped in chunks, not one round-trip each
+            self._stdio = install_remote(remote)['install_stdio'](
+                sys.stdout, sys.stderr, self.stdio_buffer, self.stdio_interval)
+            remote._config['sync_request_timeout'] = None
+            self.remote_exec = rpyc.async_(remote.modules.builtins.exec) # Independent namespace
+            # the board thread serving this connection, kill_task leaves it alone between cells
+            self._exec_ident = remote.modules.threading.get_ident()
+            # self.remote_exec = rpyc.async_(self.remote.execute) # Common namespace
+        except Exception:
+            self.remote = None
+            raise
+        self.remote = remote
+
+    def set_heartbeat(self, interval=2.0):
+        '''
+        $heartbeat(5) pings the board every 5 seconds instead of every 2.
+        '''
+        if interval <= 0:
+            print("[ rpyc-kernel ]( heartbeat interval must be positive )")
+            return
+        self.heartbeat_interval = interval
+        self.heartbeat.set_interval(interval)
+
+    def _drop_exec(self):
+        self.channels.drop('exec')
+        self.remote = None
+
+    def _background_reconnect(self, alive):
+        # heartbeat: keep exec in step with the board between cells, the beat only pings control
+        if not self._exec_lock.acquire(blocking=False):
+            return
+        try:
+            if self._executing:
+                # a cell owns exec, checked under the lock, check_connect sets it there
+                return
+            if self.remote is not None:
+                if not alive or self.remote.closed:
+                    # board gone or rebooted, what exec holds is stale as well
+                    self._drop_exec()
+                else:
+                    try:
+                        # a reaped board thread only dies, closing exec, once a request wakes it up
+                        self.remote.ping(timeout=self.channels.ping_timeout)
+                    except Exception as e:
+                        self.log.debug('[%s] exec %s' % (self.address, repr(e)))
+                        self._drop_exec()
+            if alive and self.remote is None:
+                # open it before the next cell needs it
+                try:
+                    self._open_exec()
+                    self.log.debug('[%s] exec reconnected in background' % (self.address))
+                except Exception as e:
+                    self.log.debug('[%s] background reconnect %s' % (self.address, repr(e)))
+        finally:
+            self._exec_lock.release()
+
+    def do_reconnect(self, attempts=5):
         import sys
-        for i in range(5):
+        hosts = ', '.join(host for host, _ in self.channels.endpoints())
+        for i in range(attempts):
             try:
-                self.remote = rpyc.classic.connect(self.address)
-                self.remote.modules.sys.stdin = sys.stdin
-                self.remote.modules.sys.stdout = sys.stdout
-                self.remote.modules.sys.stderr = sys.stderr
-                self.remote._config['sync_request_timeout'] = None
-                self.remote_exec = rpyc.async_(self.remote.modules.builtins.exec) # Independent namespace
-                # self.remote_exec = rpyc.async_(self.remote.execute) # Common namespace
+                self._open_exec()
                 return True
             # ConnectionRefusedError: [Errno 111] Connection refused
             except Exception as e:
                 self.remote = None
                 # self.log.debug('%s on Remote IP: %s' % (repr(e), self.address))
-                print("[ rpyc-kernel ]( Connect IP: %s at %s)" % (self.address, time.asctime()))
-            time.sleep(2)
-        print("[ rpyc-kernel ]( Connect IP: %s fail! )" % (self.address))
+                print("[ rpyc-kernel ]( Connect IP: %s at %s)" % (hosts, time.asctime()))
+            if i + 1 < attempts:
+                time.sleep(2)
+        print("[ rpyc-kernel ]( Connect IP: %s fail! )" % (hosts))
+        if self.address == "localhost":
+            print("[ rpyc-kernel ]( adb device %s %s since %s )" % (
+                self.device.serial or '', self.watcher.state, time.asctime(time.localtime(self.watcher.last_transition))))
         if sys.platform.startswith('win'):
             try:
+                adb = get_adb()
                 if adb.connect_check():
                     adb.kill_server()
             except Exception as e:
@@ -373,6 +450,17 @@ class RPycKernel(IPythonKernel):
         # sys.exit()
 
     def check_connect(self):
+        with self._exec_lock:
+            connected = self._check_connect()
+            # the heartbeat leaves exec alone from here until the cell is over
+            self._executing = bool(connected)
+            return connected
+
+    def _check_connect(self):
+        heartbeat = self.heartbeat
+        if self.remote and not self.remote.closed and heartbeat.alive:
+            # known good from the last beat, no round-trip before the cell
+            return True
         if self.remote:
             try:
                 if self.remote.closed:
@@ -383,115 +471,409 @@ class RPycKernel(IPythonKernel):
             except Exception as e:  # PingError
                 # self.log.error(repr(e))
                 if self.remote != None:
-                    self.remote.close()
+                    self.channels.drop('exec')
                     self.remote = None
+        if heartbeat.dead:
+            # known bad, one attempt instead of ten seconds of retries
+            print("[ rpyc-kernel ]( %s unreachable, last seen %s )" % (self.address,
+                '%.1fs ago' % (time.monotonic() - heartbeat.last_alive) if heartbeat.last_alive else 'never'))
+            return self.do_reconnect(attempts=1)
         return self.do_reconnect()
 
+    @property
+    def address(self):
+        # the endpoint that answered last, the first candidate before that
+        return self.channels.address
+
+    def _endpoint(self, address):
+        # forwarded ports of the bound board on localhost, a board on the network listens on its own
+        if isinstance(address, (list, tuple)):
+            return tuple(address)
+        return (address, self.device.rpyc if address == "localhost" else DEFAULT_PORTS.rpyc)
+
+    def _submit(self, code):
+        try:
+            if self.remote is None:
+                # dropped after the check, the board went away in between
+                raise EOFError('exec connection dropped')
+            return self.remote_exec(code, self.remote.modules.builtins.globals())
+        except EOFError as e:
+            # exec closed under us (reaped, board rebooted) before the cell was sent, resend it once
+            self.log.debug('[%s] exec %s, reconnecting' % (self.address, repr(e)))
+            self._drop_exec()
+            if not self.do_reconnect(attempts=1):
+                raise
+            return self.remote_exec(code, self.remote.modules.builtins.globals())
+
     def connect_remote(self, address="localhost"):
-        self.address = address
+        '''
+        $connect("192.168.0.10") or a list of candidates for the same board,
+        $connect(["localhost", "192.168.0.10"]), raced on every reconnect.
+        '''
+        candidates = address if isinstance(address, list) else [address]
+        self.channels.address = [self._endpoint(c) for c in candidates]
         self.do_reconnect()
 
-    def _ready_display(self, port=18811):
-        self._media_client, self._media_port, self._media_work = None, port, True
-        self._clear_display(self.remote)
+    def discover_boards(self, hosts=(), connect=True):
+        '''
+        $discover() lists the boards answering on the network and connects to
+        the one with the lowest round-trip; $discover(["192.168.0.10"], False)
+        adds hosts to probe and only lists.
+        '''
+        found = self.discovery.discover(hosts)
+        reachable = [e for e in found if e.reachable]
+        for e in found:
+            print("[ rpyc-kernel ]( %s:%d %s )" % (e.host, e.port,
+                '%.1f ms' % (e.rtt * 1000) if e.reachable else 'no answer'))
+        if not reachable:
+            print("[ rpyc-kernel ]( no board found, still on %s )" % (self.address))
+            return None
+        if connect:
+            self.connect_remote((reachable[0].host, reachable[0].port))
+        return reachable[0]
+
+    def _ports(self):
+        # forwarded ports of the bound board, a board on the network listens on its own
+        return self.device if self.address == "localhost" else DEFAULT_PORTS
+
+    def set_device(self, serial=None):
+        self.device = DeviceRegistry().ports(serial) if serial else DEFAULT_PORTS
+        self.watcher.stop()
+        self.watcher = config_maixpy3(self.log, self.device)
+        self.channels.address = "localhost"
+        self.channels.port = self.device.rpyc
+        self.channels.drop('exec')
+        self.remote = None
+        print("[ rpyc-kernel ]( device %s on ports %d %d %d )" % (
+            serial or 'default', self.device.mjpg, self.device.rpyc, self.device.ssh))
+
+    def _control(self):
+        # pooled connection for cleanup work, None while the board is unreachable
+        try:
+            return self.channels.get('control')
+        except Exception as e:
+            self.log.debug('control %s' % repr(e))
+            return None
+
+    def set_frame_transport(self, transport='base64'):
+        if transport not in ('base64', 'comm'):
+            print("[ rpyc-kernel ]( unknown frame transport: %s )" % (transport))
+            return
+        self.frame_transport = transport
+        if transport == 'comm' and self._frame_comm is None:
+            # the renderer opens the comm, frames go binary from the next cell on
+            self.send_response(self.iopub_socket, 'display_data', {
+                'data': {
+                    'application/javascript': FRAME_RENDERER_JS
+                },
+                'metadata': {}
+            })
+
+    def set_frame_transform(self, max_width=None, quality=None):
+        if self.frame_transform:
+            self.frame_transform.shutdown()
+            self.frame_transform = None
+        if max_width is None and quality is None:
+            return
+        self.frame_transform = FrameTransform(max_width, quality or 75)
+
+    def _open_frame_comm(self, comm, msg):
+        self.log.debug('[%s] frame comm open' % (comm.comm_id))
+        self._frame_comm = comm
+
+        def on_close(msg):
+            if self._frame_comm is comm:
+                self._frame_comm = None
+        comm.on_close(on_close)
+
+    def _ready_display(self, port=None):
+        port = port or self._ports().mjpg
+        self._media_port = port
+        self._clear_display(self._control())
+        url = "http://%s:%d" % (self.address, port)
+        if self._media_session is None or self._media_session.url != url or self._media_session.closed:
+            # one stream per device, kept open between cells
+            if self._media_session:
+                self._media_session.close()
+            self._media_session = DisplaySession(url, pool=self._media_pool, log=self.log).start()
         self._media_work = True
-        _thread.start_new_thread(self._update_display, ())
+        self._media_slot = FrameSlot(release=self._media_pool.release, totals=self.frame_totals)
+        self._media_session.attach(self._media_slot)
+        display_id = uuid.uuid4().hex if self._supports_update_display() else None
+        frame_comm = self._frame_comm if self.frame_transport == 'comm' else None
+        _thread.start_new_thread(self._update_display, (self._media_slot, display_id, frame_comm))
 
     def _clear_display(self, remote):
-        self.log.debug('[%s] _clear_display %s %s' % (self.remote, self._media_work, self._media_client))
+        self.log.debug('[%s] _clear_display %s %s' % (self.remote, self._media_work, self._media_session))
         try:
             # if self._media_work == True or self._media_client != None:
             #     self.log.info('[%s] _media_work %s _media_client %s' % (self.remote, self._media_work, self._media_client))
             #     time.sleep(1) # many while True maybe ouput last result
             self._media_work = False
+            if self._media_session:
+                self._media_session.detach()
+            if self._media_slot:
+                self._media_slot.close()
             remote.modules['maix.mjpg'].clear_mjpg()
         except Exception as e:
             self.log.debug(e)
 
-    def _update_display(self):
-        # return
-        while self._media_work:
+    def _supports_update_display(self):
+        # update_display_data arrived with message protocol 5.1
+        if not self.update_display:
+            return False
+        try:
+            parent = self.get_parent() if hasattr(self, 'get_parent') else self._parent_header
+            version = parent['header'].get('version', '5.0')
+            return tuple(int(v) for v in version.split('.')[:2]) >= (5, 1)
+        except Exception as e:
+            self.log.debug(e)
+            return False
+
+    def _update_display(self, slot, display_id=None, frame_comm=None):
+        shown = False
+        if frame_comm is not None:
+            display_id = display_id or uuid.uuid4().hex
+        while self._media_work and not slot.closed:
+            content = slot.get(timeout=0.1)
+            if content is None:
+                continue
             try:
-                self.log.debug('[%s] _update_display_ ' % (self._media_client))
-                if self._media_client == None:
-                    try:
-                        self._media_client = MjpgSocket("http://%s:%d" % (self.address, self._media_port))
-                        self.log.debug('[%s] connect... (%s)' % (self._media_client, os.getpid()))
-                    except socket.timeout as e:
-                        self.log.debug(e)
-                        break
-                if self._media_client != None:
-                    # for content in self._media_client.iter_content():
-                    #     self.log.info('iter_content... (%s)' % len(content))
-                    try:
-                        content = next(self._media_client.iter_content())
-                        image_type = imghdr.what(None, content)
-                        # import io
-                        # self.log.info(image_type)
-                        # img = io.BytesIO(content)
-                        # Image.open(img)
-                        # tmp = Image.open()
-                        # buf = io.BytesIO()
-                        # tmp.resize((tmp.size[0], tmp.size[1])).save(buf, format = "JPEG")
-                        # buf.flush()
-                        # content = buf.getvalue()
-                        if self.clear_output:  # used when updating lines printed
-                            self.send_response(self.iopub_socket,
-                                                'clear_output', {"wait": True})
-                        # self.log.info(content)
-                        # image_type = imghdr.what(None, content)
-                        # self.log.info(image_type)
-                        image_data = base64.b64encode(content).decode('iso8859-1')
-                        # self.log.info(len(image_data))
+                if self.frame_transform:
+                    # newer frames keep landing in the slot while this one is in the pool
+                    frame, content = content, self.frame_transform(content, timeout=5)
+                    self._media_pool.release(frame)
+                mimetype = 'image/' + image_type(content)
+                if frame_comm is not None and frame_comm is self._frame_comm:
+                    # raw jpeg as a zmq buffer, no base64 on either side
+                    if not shown:
                         self.send_response(self.iopub_socket, 'display_data', {
                             'data': {
-                                'image/' + image_type: image_data
+                                'text/html': frame_placeholder(display_id)
                             },
-                            'metadata': {}
+                            'metadata': {},
+                            'transient': {'display_id': display_id}
                         })
-                    except Exception as e:
-                        self.log.debug('[%s] Exception %s' % (self._media_client, e))
-                    # except UnicodeDecodeError as e:
-                    #     self.log.debug('[%s] UnicodeDecodeError %s ' % (self._media_client, e))
-                    except Image.UnidentifiedImageError as e:
-                        self.log.debug('[%s] UnidentifiedImageError %s' % (self._media_client, e))
-                    # time.sleep(0.02)
-                time.sleep(0.01)
-            # except OSError as e:
-            #     pass
-            # except ConnectionResetError as e:
+                        shown = True
+                    # iopub sends from its own thread later, so this frame is not recycled
+                    frame_comm.send({'display_id': display_id, 'mimetype': mimetype},
+                                    buffers=[content])
+                    self._count_frame(content)
+                    continue
+                image_data = base64.b64encode(content).decode('iso8859-1')
+                self._count_frame(content)
+                self._media_pool.release(content)
+                message = {
+                    'data': {
+                        mimetype: image_data
+                    },
+                    'metadata': {}
+                }
+                if display_id:
+                    # one output per cell, later frames only replace its data
+                    message['transient'] = {'display_id': display_id}
+                    self.send_response(self.iopub_socket,
+                                       'update_display_data' if shown else 'display_data', message)
+                    shown = True
+                    continue
+                if self.clear_output:  # used when updating lines printed
+                    self.send_response(self.iopub_socket,
+                                        'clear_output', {"wait": True})
+                self.send_response(self.iopub_socket, 'display_data', message)
             except Exception as e:
-                self.log.debug(e)
-                # import traceback
-                # traceback.print_exc()
-        if (self._media_client):
+                self.log.debug('[%s] Exception %s' % (self._media_port, e))
+        slot.close()
+        self.log.debug('[%s] frames %s' % (self._media_port, slot.stats()))
+
+    def _count_frame(self, content):
+        # either transport, the jpeg as it left the kernel
+        self.metrics.inc('frames_sent_total', help='preview frames sent to the front end')
+        self.metrics.inc('frame_bytes_sent_total', len(content), help='jpeg bytes of the preview frames sent')
+
+    def attach_log(self, cmd='dmesg -w', lines=None):
+        '''
+        Follow cmd on the board (adb shell) in a panel of the current cell,
+        until the cell ends.
+        '''
+        self._close_log()
+        try:
+            self._log_stream = get_device(self.device.serial)[0].stream(['shell', cmd])
+        except Exception as e:
+            print("[ rpyc-kernel ]( log %s fail! %s )" % (cmd, e))
+            return
+        display_id = uuid.uuid4().hex if self._supports_update_display() else None
+        _thread.start_new_thread(self._update_log, (self._log_stream, cmd, lines or self.log_lines, display_id))
+
+    def _close_log(self):
+        if self._log_stream:
+            self._log_stream.close()
+            self._log_stream = None
+
+    def _update_log(self, stream, cmd, lines, display_id=None):
+        tail = collections.deque(maxlen=lines)
+        shown = False
+        while not stream.closed:
+            new = stream.read(timeout=self.log_interval)
+            if not new:
+                continue
+            tail.extend(new)
             try:
-                self._media_client.stream.close()
+                if display_id:
+                    # one panel, redrawn with the last lines
+                    header = "[ rpyc-kernel ]( %s: %d lines, %d dropped )" % (cmd, stream.received, stream.dropped)
+                    self.send_response(self.iopub_socket, 'update_display_data' if shown else 'display_data', {
+                        'data': {
+                            'text/plain': '\n'.join([header] + list(tail))
+                        },
+                        'metadata': {},
+                        'transient': {'display_id': display_id}
+                    })
+                    shown = True
+                else:
+                    self.send_response(self.iopub_socket, 'stream', {
+                        'name': 'stdout',
+                        'text': ''.join(line + '\n' for line in new)
+                    })
             except Exception as e:
-                self.log.debug('[%s] Exception ' % (e))
-            self._media_client = None
+                self.log.debug('[log] Exception %s' % e)
+            # at most one update per interval, what arrives meanwhile goes in the next one
+            time.sleep(self.log_interval)
 
-    def kill_task(self):
+    def _flush_stdio(self):
+        # everything the cell printed has to be out before its reply
         try:
-            master = rpyc.classic.connect(self.address)
-            thread = master.modules.threading
-            # print(thread.enumerate()) # kill remote's thread
-            lists = [i for i in thread.enumerate() if i.__class__.__name__ not in [
-                'MjpgServerThread', '_MainThread']]
-            kills = [i.ident for i in lists if i.ident not in [
-                thread.main_thread().ident, thread.get_ident()]]
-            # print(kills)
-            for id in kills:
-                try:
-                    master.teleport(_async_raise)(id)
-                except Exception as e:
-                    self.log.debug('teleport Exception (%s)' % repr(e))
-            # print(master.modules.threading.enumerate())
-            # master.modules['traceback'].print_exc()
-            self._clear_display(master)
-            master.close()
+            if self._stdio is not None:
+                self._stdio.flush()
         except Exception as e:
-            self.log.debug(e)
+            self.log.debug('flush Exception (%s)' % repr(e))
+
+    def kill_task(self, interrupted=False):
+        master = self._control()
+        if master is not None:
+            try:
+                if self._reaper_conn is not master:
+                    # installed once per control connection, then one round-trip per cell
+                    self._reaper = install_remote(master)['reap_threads']
+                    self._reaper_conn = master
+                # the cell has returned, its connection stays up for the next one
+                keep = () if interrupted else (self._exec_ident, )
+                stopped = self._reaper(keep)
+                self.log.debug('reap_threads %s' % (stopped, ))
+                self._clear_display(master)
+            except Exception as e:
+                self.log.debug(e)
+                self.channels.drop('control')
+        if interrupted:
+            # the board thread serving exec went with the cell and the board closes its socket,
+            # the host has not read that yet; the heartbeat opens a new one
+            self._drop_exec()
+
+    def do_shutdown(self, restart):
+        self.set_metrics(None)
+        self._close_log()
+        self.heartbeat.stop()
+        self.watcher.stop()
+        self.channels.close()
+        if self._media_session:
+            self._media_session.close()
+        if self.frame_transform:
+            self.frame_transform.shutdown()
+        return IPythonKernel.do_shutdown(self, restart)
+
+    def print_stats(self, reset=False):
+        '''
+        $stats() prints percentiles of the phase timings of the last cells,
+        $stats(True) also starts over.
+        '''
+        if not self.timer.history:
+            print("[ rpyc-kernel ]( no cell timed yet )")
+        else:
+            print("[ rpyc-kernel ]( last %d cells, ms )\n%s" % (len(self.timer.history), self.timer.report()))
+        if reset:
+            self.timer.history.clear()
+
+    def _on_channel(self, name, conn):
+        self.metrics.inc('rpyc_connects_total', help='rpyc connections opened to the board')
+        if self.profiling:
+            self.profiler.attach(name, conn)
+
+    def set_profile(self, enabled=True):
+        '''
+        $profile(True) counts the rpyc requests of the kernel's connections
+        and prints them after every cell, $profile(False) stops.
+        '''
+        self.profiling = enabled
+        if not enabled:
+            self.profiler.detach_all()
+            return
+        for name in ('exec', 'control'):
+            conn = self.channels.peek(name)
+            if conn is not None and not conn.closed:
+                self.profiler.attach(name, conn)
+
+    def set_metrics(self, target=None, interval=10.0):
+        '''
+        $metrics(9464) serves the kernel's metrics on
+        http://127.0.0.1:9464/metrics in the Prometheus text format,
+        $metrics("/path/kernel.json") rewrites a json file every interval
+        seconds, $metrics() stops.
+        '''
+        if self._metrics_export:
+            self._metrics_export.stop()
+            self._metrics_export = None
+        if target is None:
+            return
+        try:
+            self._metrics_export = export_metrics(self.metrics, target, interval)
+        except OSError as e:
+            print("[ rpyc-kernel ]( metrics %s: %s )" % (target, e))
+            return
+        port = getattr(self._metrics_export, 'port', None)
+        print("[ rpyc-kernel ]( metrics on %s )" % (
+            'http://127.0.0.1:%d/metrics' % port if port else self._metrics_export.path))
+
+    def _metric_samples(self):
+        # read at export time from what counts on its own
+        heartbeat, session = self.heartbeat, self._media_session
+        samples = [Sample('frames_%s_total' % key, 'counter', 'preview frames %s' % key, self.frame_totals[key])
+                   for key in ('received', 'published', 'dropped')]
+        if session is not None:
+            samples += [
+                Sample('mjpg_frames_total', 'counter', 'frames read off the mjpg stream', session.frames),
+                Sample('mjpg_bytes_total', 'counter', 'bytes of the frames read off the mjpg stream', session.bytes),
+                Sample('mjpg_connects_total', 'counter', 'mjpg stream connections', session.connects),
+            ]
+        samples += [
+            Sample('board_up', 'gauge', '1 when the last heartbeat was answered', int(heartbeat.state == 'alive')),
+            Sample('rpyc_rtt_seconds', 'gauge', 'round-trip of the last heartbeat ping', heartbeat.rtt),
+            Sample('heartbeat_failures_total', 'counter', 'heartbeats not answered', heartbeat.failures),
+            Sample('adb_commands_total', 'counter', 'adb commands run', adb_stats.commands),
+            Sample('adb_command_failures_total', 'counter', 'adb commands failed or timed out', adb_stats.failures),
+            Sample('adb_command_seconds_total', 'counter', 'seconds spent in adb commands', adb_stats.seconds),
+            Sample('adb_binds_total', 'counter', 'forward and restart sequences run', self.watcher.binds),
+        ]
+        return samples
+
+    def _count_iopub(self, session):
+        # every iopub message goes through the session: outputs, prints, status, comm frames;
+        # prints are sent to the IOPubThread behind iopub_socket
+        if session is None:
+            return
+        send = session.send
+
+        def counted(stream, *args, **kwargs):
+            iopub = self.iopub_socket
+            if stream is not None and (stream is iopub or stream is getattr(iopub, 'io_thread', None)):
+                self.metrics.inc('iopub_messages_total', help='iopub messages sent by the kernel')
+            return send(stream, *args, **kwargs)
+        session.send = counted
+
+    def finish_metadata(self, parent, metadata, reply_content):
+        metadata = IPythonKernel.finish_metadata(self, parent, metadata, reply_content)
+        if self.timer.last is not None:
+            # seconds per phase of this cell
+            metadata['timings'] = dict(self.timer.last)
+        return metadata
 
     def do_handle(self, code):
         # self.log.debug(code)
@@ -512,69 +894,98 @@ class RPycKernel(IPythonKernel):
 
     def do_execute(self, code, silent, store_history=True, user_expressions=None, allow_stdin=False):
         if not code.strip():
+            self.timer.last = None
             return {'status': 'ok', 'execution_count': self.execution_count,
                     'payload': [], 'user_expressions': {}}
         self.log.debug(code)
+        timer = self.timer
+        timer.begin()
+        if self.profiling:
+            self.profiler.reset()
 
         # Handle the host call code
-        code = self.do_handle(code)
+        with timer.phase('handle'):
+            code = self.do_handle(code)
 
         interrupted = False
         self.last_result = ""
-        if self.check_connect():
-            try:
-                try:
-                    print("[ rpyc-kernel ]( running at %s )" % (time.asctime()))
-                    self._ready_display()
-
-                    # self.remote.modules.builtins.exec(code)
-
-                    self.result = self.remote_exec(code, self.remote.modules.builtins.globals())
-                    # self.result.wait()
-                    def get_result(result):
-                        if result.error:
-                            pass # is error
-                            self.log.debug(result.value)
-                        # print('get_result', result, result.value, result.error)
-                    self.result.add_callback(get_result)
-                    # self.log.info('self.result.ready (%s)' % repr(self.result.ready))
-                    while self.result.ready == False:
-                        # self.log.info('self.result.ready (%s)' % repr(self.result.ready))
-                        time.sleep(0.001) # print(end='')
-                    # time.sleep(0.2)
-                    # with rpyc.classic.redirected_stdio(self.remote):
-                    #     self.remote_exec(code)
-
-                    # self.remote.execute(code)
-                    # self.log.info(self.result)
-                except KeyboardInterrupt as e:
-                    # self.remote.execute("raise KeyboardInterrupt") # maybe raise main_thread Exception
-                    interrupted = True
-                    # self.kill_task()
-                    self.last_result = '\r\nTraceback (most recent call last):\r\n  File "<string>", line unknown, in <module>\r\nRemote.KeyboardInterrupt\r\n'
-                    self.log.debug(self.last_result)
-                    # raise e
-            # remote stream has been closed(cant return info)
-            except EOFError as e:
-                self.log.debug(e)
-                # self.remote.close() # not close self
+        try:
+            with timer.phase('connect'):
+                connected = self.check_connect()
+            if connected:
                 try:
-                    self.remote.modules.os._exit(233)  # should close remote
+                    try:
+                        print("[ rpyc-kernel ]( running at %s )" % (time.asctime()))
+                        with timer.phase('display'):
+                            self._ready_display()
+
+                        # self.remote.modules.builtins.exec(code)
+
+                        with timer.phase('submit'):
+                            self.result = self._submit(code)
+                        # self.result.wait()
+                        def get_result(result):
+                            if result.error:
+                                pass # is error
+                                self.log.debug(result.value)
+                            # print('get_result', result, result.value, result.error)
+                        self.result.add_callback(get_result)
+                        # the reply (and remote print callbacks) are handled inside serve(),
+                        # which sleeps in select() instead of polling; Ctrl-C still breaks out
+                        finished = threading.Event()
+                        self.result.add_callback(lambda result: finished.set())
+                        with timer.phase('wait'):
+                            while not finished.is_set():
+                                self.remote.serve(self.wait_interval)
+                        # time.sleep(0.2)
+                        # with rpyc.classic.redirected_stdio(self.remote):
+                        #     self.remote_exec(code)
+
+                        # self.remote.execute(code)
+                        # self.log.info(self.result)
+                    except KeyboardInterrupt as e:
+                        # self.remote.execute("raise KeyboardInterrupt") # maybe raise main_thread Exception
+                        interrupted = True
+                        # self.kill_task()
+                        self.last_result = '\r\nTraceback (most recent call last):\r\n  File "<string>", line unknown, in <module>\r\nRemote.KeyboardInterrupt\r\n'
+                        self.log.debug(self.last_result)
+                        # raise e
+                # remote stream has been closed(cant return info)
+                except EOFError as e:
+                    self.log.debug(e)
+                    # self.remote.close() # not close self
+                    try:
+                        self.remote.modules.os._exit(233)  # should close remote
+                    except Exception as e:
+                        pass
                 except Exception as e:
+                    import traceback, sys
+                    # traceback.print_exc()
+                    exc_type, exc_value, exc_traceback = sys.exc_info()
+                    for s in traceback.format_exception(exc_type, exc_value, exc_traceback):
+                        if "Remote Traceback" in s:
+                            self.last_result = ""
+                        self.last_result += s
+                    # self.log.error(e)
+                    # raise e
                     pass
-            except Exception as e:
-                import traceback, sys
-                # traceback.print_exc()
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                for s in traceback.format_exception(exc_type, exc_value, exc_traceback):
-                    if "Remote Traceback" in s:
-                        self.last_result = ""
-                    self.last_result += s
-                # self.log.error(e)
-                # raise e
-                pass
-            finally:
-                self.kill_task()
+                finally:
+                    if not interrupted:
+                        # the board is still busy with the cell otherwise, a flush would wait for it
+                        with timer.phase('flush'):
+                            self._flush_stdio()
+                    with timer.phase('cleanup'):
+                        self.kill_task(interrupted)
+                    self._executing = False
+        finally:
+            # $log(...) opens its stream in do_handle, before the board is checked
+            self._close_log()
+        if self.profiling:
+            for line in self.profiler.report():
+                print("[ rpyc-kernel ]( %s )" % (line))
+        record = timer.end()
+        self.metrics.inc('cells_total', help='cells executed on the board')
+        self.metrics.inc('cell_seconds_total', record['total'], help='seconds spent executing cells')
 
         if len(self.last_result) > 0:
             self.send_response(self.iopub_socket, 'execute_result', {
@@ -0,0 +1,166 @@
+"""
+metrics.py
+
+Counters and gauges of a kernel left running as a live dashboard, served
+in the Prometheus text format on a local port or written to a json file.
+
+"""
+
+import collections
+import http.server
+import json
+import logging
+import os
+import threading
+
+from .scheduler import Scheduler
+
+# a port for the http endpoint or a path for the json file, see export
+METRICS_ENV = 'RPYC_IKERNEL_METRICS'
+
+Sample = collections.namedtuple('Sample', 'name kind help value')
+
+
+class Metrics():
+    '''
+    Counters (inc) and gauges (set) by name, and collectors: callables
+    returning Samples read at export time from objects that count on their
+    own (the heartbeat, the adb wrapper). Names get prefix.
+    '''
+
+    def __init__(self, prefix='rpyc_ikernel'):
+        self.prefix = prefix
+        self._values = collections.OrderedDict()
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, help=''):
+        with self._lock:
+            kind, doc, old = self._values.get(name, ('counter', help, 0))
+            self._values[name] = (kind, doc or help, old + value)
+
+    def set(self, name, value, help=''):
+        with self._lock:
+            doc = self._values.get(name, (None, help, None))[1]
+            self._values[name] = ('gauge', doc or help, value)
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def samples(self):
+        with self._lock:
+            samples = [Sample(name, kind, doc, value) for name, (kind, doc, value) in self._values.items()]
+        for collector in self._collectors:
+            try:
+                samples.extend(collector())
+            except Exception as e:
+                logging.getLogger("rpyc_ikernel").debug('[Metrics] collector %s' % repr(e))
+        return samples
+
+    def prometheus(self):
+        '''
+        The samples in the Prometheus text exposition format.
+        '''
+        lines = []
+        for sample in self.samples():
+            if sample.value is None:
+                continue
+            name = '%s_%s' % (self.prefix, sample.name)
+            if sample.help:
+                lines.append('# HELP %s %s' % (name, sample.help))
+            lines.append('# TYPE %s %s' % (name, sample.kind))
+            lines.append('%s %s' % (name, repr(float(sample.value))))
+        return '\n'.join(lines) + '\n'
+
+    def json(self):
+        return dict((sample.name, sample.value) for sample in self.samples())
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(http.server.ThreadingHTTPServer):
+    '''
+    GET /metrics on host:port, port 0 picks a free one (see port).
+    '''
+    daemon_threads = True
+
+    def __init__(self, metrics, port=0, host='127.0.0.1'):
+        http.server.ThreadingHTTPServer.__init__(self, (host, port), MetricsHandler)
+        self.metrics = metrics
+        self._thread = threading.Thread(target=self.serve_forever, name='MetricsServer', daemon=True)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class MetricsFile():
+    '''
+    Rewrites path with the samples as json every interval seconds, on a
+    Scheduler thread; readers never see a half written file.
+    '''
+
+    def __init__(self, metrics, path, interval=10.0):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self._scheduler = None
+
+    def write(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.metrics.json(), f, sort_keys=True, indent=2)
+        os.replace(tmp, self.path)
+
+    def _beat(self):
+        try:
+            self.write()
+        except OSError as e:
+            logging.getLogger("rpyc_ikernel").debug('[MetricsFile] %s' % repr(e))
+        # Scheduler keeps truthy return values, keep it from growing
+        return None
+
+    def start(self):
+        self.write()
+        self._scheduler = Scheduler('recur', self.interval, self._beat)
+        self._scheduler.daemon = True
+        self._scheduler.start()
+        return self
+
+    def stop(self):
+        if self._scheduler:
+            self._scheduler.cancel()
+            self._scheduler = None
+        self._beat()
+
+
+def export(metrics, target, interval=10.0):
+    '''
+    A started MetricsServer for a port (int or digits), a MetricsFile for a path.
+    '''
+    if isinstance(target, int) or str(target).isdigit():
+        return MetricsServer(metrics, int(target)).start()
+    return MetricsFile(metrics, str(target), interval).start()
@@ -0,0 +1,178 @@
+"""
+mjpg.py
+
+Buffered multipart/x-mixed-replace (MJPEG) parser.
+
+Frames are scanned out of one large reusable receive buffer with
+bytearray.find instead of readline(), and handed out as memoryviews over
+recycled buffers, so a steady stream does not allocate per frame.
+
+"""
+
+import collections
+import io
+
+
+JPEG_SOI = b'\xff\xd8'
+JPEG_EOI = b'\xff\xd9'
+
+
+class ProtoError(Exception):
+    pass
+
+
+class BufferPool():
+    '''
+    Recycles frame buffers. acquire() hands out a memoryview of at least the
+    requested length, release() takes it back once the consumer is done.
+    '''
+
+    def __init__(self, maxsize=4):
+        self._free = collections.deque(maxlen=maxsize)
+        self.allocations = 0
+
+    def acquire(self, length):
+        for _ in range(len(self._free)):
+            buf = self._free.popleft()
+            if len(buf) >= length:
+                return memoryview(buf)[:length]
+            self._free.append(buf)
+        self.allocations += 1
+        # leave some headroom so slightly bigger frames still fit next time
+        return memoryview(bytearray(length + (length >> 3)))[:length]
+
+    def release(self, frame):
+        if isinstance(frame, memoryview) and isinstance(frame.obj, bytearray):
+            self._free.append(frame.obj)
+
+
+class MjpgStream():
+    '''
+    Reads frames from a binary stream positioned right after the HTTP headers.
+    Content-Length is used when present, otherwise the JPEG is cut out of the
+    data between two boundaries by its SOI/EOI markers.
+    '''
+
+    def __init__(self, stream, boundary, bufsize=1 << 18, pool=None):
+        self.stream = stream
+        # readinto on a buffered socket file blocks until the whole buffer is full
+        self._readinto = stream.readinto1 if isinstance(stream, io.BufferedReader) else stream.readinto
+        self.boundary = boundary.encode('iso8859-1') if isinstance(boundary, str) else boundary
+        self.pool = pool if pool is not None else BufferPool()
+        self._buf = bytearray(bufsize)
+        self._start = self._end = 0
+
+    def _fill(self):
+        buf = self._buf
+        if self._start:
+            # keep the unread tail at the front of the buffer
+            size = self._end - self._start
+            if size <= self._start:
+                with memoryview(buf) as view:
+                    view[:size] = view[self._start:self._end]
+            else:
+                buf[:size] = buf[self._start:self._end]
+            self._start, self._end = 0, size
+        if self._end == len(buf):
+            buf.extend(bytes(len(buf)))
+        with memoryview(buf) as view:
+            n = self._readinto(view[self._end:])
+        if not n:
+            raise EOFError('End of stream reached')
+        self._end += n
+
+    def _find(self, sub, start):
+        while True:
+            i = self._buf.find(sub, start, self._end)
+            if i != -1:
+                return i
+            # a partial match may straddle the end of what we have so far
+            offset = max(start, self._end - len(sub) + 1) - self._start
+            self._fill()
+            start = self._start + offset
+
+    def _read_headers(self):
+        # every _find may compact the buffer, so positions are kept in self._start
+        self._start = self._find(self.boundary, self._start)
+        self._start = self._find(b'\r\n', self._start + len(self.boundary))
+        end = self._find(b'\r\n\r\n', self._start)
+        headers = bytes(self._buf[self._start + 2:end]).lower()
+        self._start = end + 4
+        return headers
+
+    def _content_length(self, headers):
+        i = headers.find(b'content-length:')
+        if i == -1:
+            return None
+        j = headers.find(b'\r\n', i)
+        try:
+            return int(headers[i + 15:j if j != -1 else len(headers)])
+        except ValueError:
+            raise ProtoError('Invalid Content-Length')
+
+    def _read_length(self, clen):
+        frame = self.pool.acquire(clen)
+        have = min(clen, self._end - self._start)
+        with memoryview(self._buf) as view:
+            frame[:have] = view[self._start:self._start + have]
+        self._start += have
+        # the rest goes straight from the socket into the frame buffer
+        while have < clen:
+            n = self.stream.readinto(frame[have:])
+            if not n:
+                raise ProtoError('Not enough data in chunk')
+            have += n
+        return frame
+
+    def _read_markers(self):
+        self._start = self._find(JPEG_SOI, self._start)
+        end = self._find(self.boundary, self._start)
+        eoi = self._buf.rfind(JPEG_EOI, self._start, end)
+        if eoi == -1:
+            raise ProtoError('JPEG end marker not found')
+        eoi += len(JPEG_EOI)
+        frame = self.pool.acquire(eoi - self._start)
+        with memoryview(self._buf) as view:
+            frame[:] = view[self._start:eoi]
+        self._start = eoi
+        return frame
+
+    def read_frame(self):
+        headers = self._read_headers()
+        clen = self._content_length(headers)
+        if clen == 0:
+            raise EOFError('End of stream reached')
+        if clen is None:
+            return self._read_markers()
+        return self._read_length(clen)
+
+    def release(self, frame):
+        self.pool.release(frame)
+
+    def iter_content(self):
+        while True:
+            yield self.read_frame()
+
+    def close(self):
+        self.stream.close()
+
+
+class MjpgReader(MjpgStream):
+    '''
+    MjpgStream over an HTTP connection, drop-in for MjpgSocket.
+    '''
+
+    def __init__(self, url, timeout=9, **kwargs):
+        import urllib.request
+        self._url = url
+        self.response = urllib.request.urlopen(url, timeout=timeout)
+        if self.response.status != 200:
+            raise ProtoError('Invalid response from server: %d' % self.response.status)
+        boundary = self.response.info().get_param('boundary', header='content-type', unquote=True)
+        if boundary is None:
+            raise ProtoError('Content-Type header does not provide boundary string')
+        # the body is not chunked, read the socket file directly to get readinto1
+        MjpgStream.__init__(self, self.response.fp, boundary, **kwargs)
+
+    def close(self):
+        self.response.close()
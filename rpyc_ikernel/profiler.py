@@ -0,0 +1,149 @@
+"""
+profiler.py
+
+Counts the rpyc traffic behind a cell: every netref attribute access, call
+or repr is a request to the board, most of them wait for the reply.
+
+"""
+
+import collections
+import threading
+import time
+
+_HANDLERS = None
+
+
+def handler_name(handler):
+    global _HANDLERS
+    if _HANDLERS is None:
+        from rpyc.core import consts
+        _HANDLERS = dict((value, name[len('HANDLE_'):].lower())
+                         for name, value in vars(consts).items() if name.startswith('HANDLE_'))
+    return _HANDLERS.get(handler, str(handler))
+
+
+class Traffic():
+    '''
+    What went over one connection: requests sent by handler, the sync ones
+    and the time spent waiting for their replies, requests served for the
+    other side (the board printing to the host streams), bytes each way.
+    '''
+
+    def __init__(self):
+        self.requests = collections.Counter()
+        self.served = collections.Counter()
+        self.sync = 0
+        self.wait = 0.0
+        self.sent = 0
+        self.received = 0
+
+    def summary(self):
+        requests = ', '.join('%s %d' % item for item in self.requests.most_common())
+        text = '%d requests (%s), %d sync %.1f ms waited, sent %d B, received %d B' % (
+            sum(self.requests.values()), requests or '-', self.sync, self.wait * 1000, self.sent, self.received)
+        if self.served:
+            text += ', served %s' % ', '.join('%s %d' % item for item in self.served.most_common())
+        return text
+
+
+class CountingStream(object):
+    '''
+    Stands in for a connection's stream (they have __slots__, their methods
+    cannot be wrapped in place) and counts the bytes read and written.
+    '''
+
+    def __init__(self, stream, count):
+        self.stream = stream
+        self._count = count
+
+    def read(self, count):
+        data = self.stream.read(count)
+        self._count('received', len(data))
+        return data
+
+    def write(self, data):
+        self._count('sent', len(data))
+        return self.stream.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class RpycProfiler():
+    '''
+    Opt-in counters on rpyc connections. attach(name, conn) wraps the
+    connection's request and dispatch methods on the instance and its
+    stream, detach(conn) puts them back; the class methods are untouched.
+    reset() starts a new count, traffic is {name: Traffic} since then.
+    '''
+
+    def __init__(self):
+        self.traffic = collections.OrderedDict()
+        self._conns = {}
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.traffic = collections.OrderedDict()
+
+    def _count(self, name):
+        traffic = self.traffic.get(name)
+        if traffic is None:
+            traffic = self.traffic[name] = Traffic()
+        return traffic
+
+    def attach(self, name, conn):
+        if id(conn) in self._conns:
+            return conn
+        lock = self._lock
+        _async_request, sync_request = conn._async_request, conn.sync_request
+        _dispatch_request = conn._dispatch_request
+
+        def request(handler, args=(), callback=(lambda a, b: None)):
+            with lock:
+                self._count(name).requests[handler_name(handler)] += 1
+            return _async_request(handler, args, callback)
+
+        def sync(handler, *args):
+            start = time.perf_counter()
+            try:
+                return sync_request(handler, *args)
+            finally:
+                with lock:
+                    traffic = self._count(name)
+                    traffic.sync += 1
+                    traffic.wait += time.perf_counter() - start
+
+        def dispatch(seq, raw_args):
+            with lock:
+                self._count(name).served[handler_name(raw_args[0])] += 1
+            return _dispatch_request(seq, raw_args)
+
+        def count(direction, size):
+            with lock:
+                traffic = self._count(name)
+                setattr(traffic, direction, getattr(traffic, direction) + size)
+
+        conn._async_request, conn.sync_request, conn._dispatch_request = request, sync, dispatch
+        conn._channel.stream = CountingStream(conn._channel.stream, count)
+        self._conns[id(conn)] = conn
+        return conn
+
+    def detach(self, conn):
+        if self._conns.pop(id(conn), None) is None:
+            return
+        for attr in ('_async_request', 'sync_request', '_dispatch_request'):
+            conn.__dict__.pop(attr, None)
+        if isinstance(conn._channel.stream, CountingStream):
+            conn._channel.stream = conn._channel.stream.stream
+
+    def detach_all(self):
+        for conn in list(self._conns.values()):
+            self.detach(conn)
+
+    def report(self):
+        '''
+        One line per connection that saw traffic since reset().
+        '''
+        with self._lock:
+            return ['rpyc %s: %s' % (name, traffic.summary()) for name, traffic in self.traffic.items()]
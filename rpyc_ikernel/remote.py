@@ -0,0 +1,191 @@
+"""
+remote.py
+
+Helpers that run on the board. The source of this module is executed in
+the namespace of an rpyc connection (see install), so it may only use the
+standard library (and rpyc, which serves it) and must keep working on the board's Python.
+
+"""
+
+import threading
+import time
+
+
+class BufferedStdio(object):
+    '''
+    Collects what remote code prints and forwards it to the host streams in
+    chunks, on size or every interval seconds, instead of one rpyc round-trip
+    per write. A single buffer is shared by stdout and stderr so the order
+    between the two is kept.
+    '''
+
+    def __init__(self, stdout, stderr, size=4096, interval=0.05):
+        self.targets = (stdout, stderr)
+        self._writers = tuple(_async_writer(target) for target in self.targets)
+        self.size = size
+        self.interval = interval
+        self.stdout = BufferedWriter(self, 0)
+        self.stderr = BufferedWriter(self, 1)
+        self._lock = threading.RLock()
+        self._chunks = []
+        self._stream = 0
+        self._length = 0
+        self._flusher = StdioFlusher(self)
+        self._flusher.start()
+
+    def write(self, stream, data):
+        with self._lock:
+            if stream != self._stream:
+                self._flush()
+                self._stream = stream
+            self._chunks.append(data)
+            self._length += len(data)
+            if self._length >= self.size:
+                self._flush()
+        return len(data)
+
+    def pending(self):
+        return self._length
+
+    def _flush(self):
+        if self._chunks:
+            data = ''.join(self._chunks)
+            self._chunks, self._length = [], 0
+            # fire and forget: a blocking call would wait for the host while
+            # holding the lock, and the host may be waiting on that lock in
+            # flush(). The writes reach the host before the flush() reply.
+            self._writers[self._stream](data)
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        self._flusher.stop()
+        self.flush()
+
+
+def _async_writer(target):
+    '''
+    write+flush of target as one-way rpyc requests, plain calls for local
+    streams.
+    '''
+    try:
+        import rpyc
+        write, flush = rpyc.async_(target.write), rpyc.async_(target.flush)
+        _nodelay(target)
+    except (ImportError, TypeError):
+        write, flush = target.write, target.flush
+
+    def send(data):
+        write(data)
+        flush()
+    return send
+
+
+def _nodelay(netref):
+    # nothing answers a one-way request, with Nagle on the reply that follows
+    # it would wait for the host's delayed ack
+    import socket
+    try:
+        conn = object.__getattribute__(netref, '____conn__')
+        conn._channel.stream.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except Exception:
+        pass
+
+
+class BufferedWriter(object):
+
+    def __init__(self, stdio, stream):
+        self._stdio = stdio
+        self._stream = stream
+
+    def write(self, data):
+        return self._stdio.write(self._stream, data)
+
+    def flush(self):
+        # print(..., flush=True) keeps working, it just is not a round-trip per call
+        pass
+
+    def isatty(self):
+        return False
+
+    @property
+    def encoding(self):
+        return 'utf-8'
+
+
+class StdioFlusher(threading.Thread):
+    '''
+    Ships whatever is buffered every interval, so output of a quiet loop does
+    not wait for the next chunk to fill up.
+    '''
+
+    def __init__(self, stdio):
+        threading.Thread.__init__(self, name='StdioFlusher')
+        self.daemon = True
+        self._stdio = stdio
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self._stdio.interval):
+            if self._stdio.pending():
+                try:
+                    self._stdio.flush()
+                except Exception:
+                    time.sleep(self._stdio.interval)
+
+    def stop(self):
+        self._stopped.set()
+
+
+def install_stdio(stdout, stderr, size=4096, interval=0.05):
+    import sys
+    old = getattr(sys.stdout, '_stdio', None)
+    if old is not None:
+        # left over from an earlier connection, its host streams may be gone
+        try:
+            old.close()
+        except Exception:
+            pass
+    stdio = BufferedStdio(stdout, stderr, size, interval)
+    sys.stdout, sys.stderr = stdio.stdout, stdio.stderr
+    return stdio
+
+
+# threads reap_threads must leave running
+KEEP_THREADS = ('MjpgServerThread', '_MainThread', 'StdioFlusher')
+
+
+def reap_threads(keep=(), exctype=KeyboardInterrupt):
+    '''
+    Raise exctype in every thread of the board except the main thread, the
+    caller's own, the idents in keep and the KEEP_THREADS classes. All of it
+    happens in this one call; returns ((ident, name), ...) of the threads hit.
+    '''
+    import ctypes
+    skip = set(keep)
+    skip.update((threading.main_thread().ident, threading.get_ident()))
+    stopped = []
+    for thread in threading.enumerate():
+        if thread.ident in skip or thread.__class__.__name__ in KEEP_THREADS:
+            continue
+        tid = ctypes.c_long(thread.ident)
+        res = ctypes.pythonapi.PyThreadState_SetAsyncExc(tid, ctypes.py_object(exctype))
+        if res == 1:
+            stopped.append((thread.ident, thread.name))
+        elif res > 1:
+            # more than one thread state touched, undo it
+            ctypes.pythonapi.PyThreadState_SetAsyncExc(tid, None)
+    # a tuple of plain values comes back in the reply, not as a netref
+    return tuple(stopped)
+
+
+def install(conn):
+    '''
+    Execute this module on the other side of conn, returns its namespace.
+    '''
+    import inspect
+    import sys
+    conn.execute(inspect.getsource(sys.modules[__name__]))
+    return conn.namespace
@@ -0,0 +1,89 @@
+"""
+stats.py
+
+Where the time of a cell goes: the link (connect, wait), the board (wait)
+or the kernel (handle, display, flush, cleanup).
+
+"""
+
+import collections
+import contextlib
+import math
+import time
+
+
+def percentile(values, q):
+    '''
+    Nearest-rank percentile of sorted values, q in 0..100.
+    '''
+    if not values:
+        return None
+    rank = max(int(math.ceil(q / 100.0 * len(values))), 1)
+    return values[min(rank, len(values)) - 1]
+
+
+class PhaseTimer():
+    '''
+    Monotonic timings of the phases of a cell, in seconds. begin() starts a
+    cell, phase(name) times a block of it, end() closes it with its total
+    and keeps it in a history of the last `history` cells.
+    '''
+
+    def __init__(self, history=500):
+        self.history = collections.deque(maxlen=history)
+        self.last = None
+        self._current = None
+        self._start = None
+
+    def begin(self):
+        self._current = collections.OrderedDict()
+        self._start = time.perf_counter()
+        self.last = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        if self._current is not None:
+            self._current[name] = self._current.get(name, 0.0) + seconds
+
+    def end(self):
+        if self._current is None:
+            return None
+        self._current['total'] = time.perf_counter() - self._start
+        self.last, self._current = self._current, None
+        self.history.append(self.last)
+        return self.last
+
+    def phases(self):
+        names = []
+        for record in self.history:
+            names.extend(name for name in record if name not in names)
+        return names
+
+    def percentiles(self, qs=(50, 90, 99)):
+        '''
+        {phase: {'n': count, 50: seconds, 90: ..., 'max': seconds}} over the history.
+        '''
+        summary = collections.OrderedDict()
+        for name in self.phases():
+            values = sorted(record[name] for record in self.history if name in record)
+            row = {'n': len(values), 'max': values[-1]}
+            row.update((q, percentile(values, q)) for q in qs)
+            summary[name] = row
+        return summary
+
+    def report(self, qs=(50, 90, 99)):
+        '''
+        The percentiles as a text table, milliseconds.
+        '''
+        lines = ['%-10s %6s' % ('phase', 'n') + ''.join('%10s' % ('p%d' % q) for q in qs) + '%10s' % 'max']
+        for name, row in self.percentiles(qs).items():
+            lines.append('%-10s %6d' % (name, row['n'])
+                         + ''.join('%10.2f' % (row[q] * 1000) for q in qs) + '%10.2f' % (row['max'] * 1000))
+        return '\n'.join(lines)
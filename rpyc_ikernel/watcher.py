@@ -0,0 +1,166 @@
+"""
+watcher.py
+
+Keeps the board's services (mjpg on 18811, rpyc on 18812) reachable over
+adb without polling the device every second.
+
+"""
+
+import logging
+import socket
+import threading
+import time
+
+from .adb_client import AdbClient, AdbServerError
+from .health import HealthChecker
+
+
+class DeviceWatcher():
+    '''
+    Follows the adb device list through `adb track-devices` and checks the
+    services with health (a HealthChecker) every probe_interval seconds:
+    a TCP connect to each forwarded port, no adb command and nothing run on
+    the board. Only when that fails the deep check (HTTP HEAD, rpyc ping)
+    decides whether bind, the expensive forward-and-restart sequence, runs;
+    it also runs when the device shows up. on_device is
+    called with True/False when the device comes and goes. start_server is
+    called when nothing listens on the adb port (the adb binary starts the
+    server, the socket client cannot), tracking then resumes right away.
+
+    state is one of
+        'offline'  no device (or no adb server)
+        'binding'  bind is running
+        'ready'    the services answer
+        'down'     device present, the services do not answer after bind
+    '''
+
+    def __init__(self, bind, serial=None, health=None,
+                 probe_interval=5.0, retry_interval=5.0, client=None, on_device=None,
+                 start_server=None, log=None):
+        self.bind = bind
+        self.start_server = start_server
+        self.on_device = on_device
+        self.serial = serial
+        self.health = health or HealthChecker()
+        self.probe_interval = probe_interval
+        self.retry_interval = retry_interval
+        self.client = client or AdbClient()
+        self.log = log or logging.getLogger("rpyc_ikernel")
+        self.state = 'offline'
+        self.last_transition = time.time()
+        self.present = False
+        self.binds = 0
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._track = None
+        self._threads = []
+
+    def start(self):
+        for target, name in ((self._run_tracker, 'DeviceTracker'), (self._run_prober, 'DeviceProber')):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        track, self._track = self._track, None
+        if track is not None:
+            try:
+                track.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            track.close()
+
+    @property
+    def stopped(self):
+        return self._stopped.is_set()
+
+    def _set_state(self, state):
+        if state != self.state:
+            self.log.debug('[DeviceWatcher] %s -> %s' % (self.state, state))
+            self.state = state
+            self.last_transition = time.time()
+
+    def _has_device(self, devices):
+        for dev in devices:
+            if len(dev) > 1 and dev[1] == 'device' and self.serial in (None, dev[0]):
+                return True
+        return False
+
+    def _set_present(self, present):
+        if present == self.present:
+            return
+        self.present = present
+        if not present:
+            self._set_state('offline')
+        if self.on_device:
+            try:
+                self.on_device(present)
+            except Exception as e:
+                self.log.debug('[DeviceWatcher] on_device %s' % repr(e))
+        self._wakeup.set()
+
+    def _start_server(self):
+        try:
+            self.start_server()
+            return True
+        except Exception as e:
+            self.log.debug('[DeviceWatcher] start-server %s' % repr(e))
+            return False
+
+    def _run_tracker(self):
+        started = False
+        while not self.stopped:
+            retry = self.retry_interval
+            try:
+                self._track = self.client.track_devices()
+                started = False
+                while not self.stopped:
+                    self._set_present(self._has_device(self.client.read_devices(self._track)))
+            except AdbServerError as e:
+                self.log.debug('[DeviceWatcher] %s' % e)
+                # once per outage, a server that does not come up is retried after retry_interval
+                if self.start_server is not None and not started:
+                    started = self._start_server()
+                    retry = 0 if started else retry
+            except Exception as e:
+                # server killed or restarted, track again
+                self.log.debug('[DeviceWatcher] track-devices %s' % repr(e))
+            if self._track is not None:
+                self._track.close()
+                self._track = None
+            self._set_present(False)
+            self._stopped.wait(retry)
+
+    def services_up(self, deep=False):
+        return self.health.ok(deep)
+
+    def _run_prober(self):
+        while not self.stopped:
+            self._wakeup.wait(self.probe_interval)
+            self._wakeup.clear()
+            if self.stopped or not self.present:
+                continue
+            if self.services_up() or self.services_up(deep=True):
+                self._set_state('ready')
+                continue
+            self._set_state('binding')
+            self.binds += 1
+            try:
+                self.bind()
+            except Exception as e:
+                self.log.debug('[DeviceWatcher] bind %s' % repr(e))
+            if not self.present:
+                self._set_state('offline')
+                continue
+            # the board side takes a moment to start listening
+            deadline = time.monotonic() + self.probe_interval
+            while not self.services_up():
+                if self.stopped or time.monotonic() > deadline:
+                    self._set_state('down')
+                    break
+                time.sleep(0.2)
+            else:
+                self._set_state('ready')
@@ -22,7 +22,7 @@ setup(
     packages=["rpyc_ikernel"],
     # scripts=scripts,
     # entry_points={"console_scripts": ["rpyc_ikernel = rpyc_ikernel.__main__:main"]},
-    install_requires=["notebook", "pexpect", "rpyc", "pillow"],
+    install_requires=["notebook", "rpyc", "pillow"],
     tests_requires=["pytest", "scripttest"],
     include_package_data=True,
     classifiers=[
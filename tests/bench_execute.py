@@ -0,0 +1,64 @@
+"""
+bench_execute.py
+
+Host CPU used while waiting for a long, idle remote cell: the old 1 ms
+busy-poll on AsyncResult.ready against the event driven wait do_execute
+uses now. Runs against a local rpyc classic server in a child process,
+so only the waiting side is counted.
+
+    python tests/bench_execute.py [seconds]
+
+"""
+
+import subprocess
+import sys
+import threading
+import time
+
+import rpyc
+
+PORT = 18879
+
+
+def busy_poll(conn, result):
+    while result.ready == False:
+        time.sleep(0.001)
+
+
+def event_wait(conn, result):
+    finished = threading.Event()
+    result.add_callback(lambda result: finished.set())
+    while not finished.is_set():
+        conn.serve(1)
+
+
+def measure(wait, seconds):
+    conn = rpyc.classic.connect('localhost', port=PORT)
+    conn._config['sync_request_timeout'] = None
+    remote_exec = rpyc.async_(conn.modules.builtins.exec)
+    start_cpu, start = time.process_time(), time.perf_counter()
+    result = remote_exec('import time; time.sleep(%f)' % seconds, conn.modules.builtins.globals())
+    wait(conn, result)
+    result.value
+    cpu, elapsed = time.process_time() - start_cpu, time.perf_counter() - start
+    conn.close()
+    return cpu, elapsed
+
+
+def main(argv):
+    seconds = float(argv[1]) if len(argv) > 1 else 60
+    server = subprocess.Popen([sys.executable, '-c',
+        'from rpyc.utils.server import ThreadedServer; from rpyc import SlaveService; '
+        'ThreadedServer(SlaveService, port=%d, auto_register=False).start()' % PORT])
+    time.sleep(1)
+    try:
+        for name, wait in (('busy-poll', busy_poll), ('event', event_wait)):
+            cpu, elapsed = measure(wait, seconds)
+            print('%-10s %6.2fs host cpu over %6.2fs (%5.1f%% of a core)' % (
+                name, cpu, elapsed, 100.0 * cpu / elapsed))
+    finally:
+        server.kill()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
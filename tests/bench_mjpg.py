@@ -0,0 +1,80 @@
+"""
+bench_mjpg.py
+
+Compare the readline based MjpgSocket with the buffered MjpgStream on a
+synthetic multipart stream: frames/sec, and the memory newly allocated
+while reading each frame (tracemalloc peak growth).
+
+    python tests/bench_mjpg.py [frames] [frame_size]
+
+"""
+
+import io
+import os
+import sys
+import time
+import tracemalloc
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(TESTS)
+# run from a checkout: the package and the test helpers
+sys.path[:0] = [ROOT, TESTS]
+
+from rpyc_ikernel.kernel import MjpgSocket
+from rpyc_ikernel.mjpg import MjpgStream
+
+from test_mjpg import BOUNDARY, make_frame, make_stream
+
+
+def mjpgsocket(stream):
+    parser = MjpgSocket.__new__(MjpgSocket)
+    return lambda: parser.read_mjpeg_frame(stream, BOUNDARY), lambda frame: None
+
+
+def mjpgstream(stream):
+    parser = MjpgStream(stream, BOUNDARY)
+    return parser.read_frame, parser.release
+
+
+def speed(reader, data):
+    read, release = reader(io.BytesIO(data))
+    frames = 0
+    start = time.perf_counter()
+    try:
+        while True:
+            release(read())
+            frames += 1
+    except EOFError:
+        pass
+    return frames, time.perf_counter() - start
+
+
+def allocated(reader, data, frames=200):
+    read, release = reader(io.BytesIO(data))
+    # warm up, the buffered parser allocates its receive buffer and pool once
+    release(read())
+    tracemalloc.start()
+    total = 0
+    for _ in range(frames):
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        release(read())
+        total += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+    return total / frames
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 2000
+    size = int(argv[2]) if len(argv) > 2 else 30000
+    data = make_stream([make_frame(i, size) for i in range(count)]).getvalue()
+    print('%d frames of %d bytes' % (count, size + 4))
+    for name, reader in (('MjpgSocket', mjpgsocket), ('MjpgStream', mjpgstream)):
+        frames, elapsed = speed(reader, data)
+        assert frames == count
+        print('%-12s %10.0f frames/s %10.2f KiB allocated/frame' % (
+            name, frames / elapsed, allocated(reader, data, min(200, count - 1)) / 1024.0))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
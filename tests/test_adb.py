@@ -0,0 +1,321 @@
+"""
+test_adb.py
+
+Check the ADB wrapper against a fake adb that runs commands on the host,
+and the socket backend against a fake adb server.
+
+"""
+
+import asyncio
+import os
+import socketserver
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from rpyc_ikernel.adb import ADB, AdbResult, AdbShell
+from rpyc_ikernel.adb_client import AdbClient, AdbError
+
+pytestmark = pytest.mark.skipif(sys.platform == "win32", reason="needs a POSIX shell")
+
+FAKE_ADB = """#!/bin/sh
+[ "$1" = "-s" ] && shift 2
+if [ "$1" = "shell" ]; then
+    shift
+    [ $# -eq 0 ] && exec sh
+    exec sh -c "$*"
+fi
+echo "unknown command $*" >&2
+exit 1
+"""
+
+
+@pytest.fixture
+def fake_adb(tmp_path):
+    path = tmp_path / "adb"
+    path.write_text(FAKE_ADB)
+    os.chmod(str(path), 0o755)
+    return str(path)
+
+
+def test_shell_session(fake_adb):
+    shell = AdbShell([fake_adb, "shell"])
+    try:
+        assert shell.run("echo hi; false") == (b"hi\n", 1)
+        assert shell.run("printf abc") == (b"abc", 0)
+        # commands do not eat the sentinel off stdin
+        assert shell.run("cat; echo done") == (b"done\n", 0)
+        pid = shell.run("echo $$")[0]
+        assert shell.run("echo $$")[0] == pid
+        # respawned after the shell dies
+        assert shell.run("exit 3") == (b"", None)
+        assert shell.run("echo back") == (b"back\n", 0)
+    finally:
+        shell.close()
+
+
+def test_adb_shell_session(fake_adb):
+    adb = ADB(fake_adb, shell_session=True)
+    assert adb.run_shell_cmd("ps | grep 'no such process' | awk '{print $1}'") == b""
+    assert adb.get_return_code() == 0
+    adb.run_shell_cmd("false")
+    assert adb.get_return_code() == 1
+    assert adb.run_shell_cmd(["echo", "one", "two"]) == b"one two\n"
+    assert adb.connect_check()
+
+
+def test_run(fake_adb):
+    adb = ADB(fake_adb)
+
+    async def main():
+        # three slow commands overlap instead of queueing on shared state
+        start = time.monotonic()
+        results = await asyncio.gather(*[adb.shell("sleep 0.5; echo %d" % i) for i in range(3)])
+        assert time.monotonic() - start < 1.2
+        assert [r.output for r in results] == [b"0\n", b"1\n", b"2\n"]
+        failed = await adb.run(["bogus"])
+        assert failed.failed and failed.error == b"unknown command bogus\n"
+        start = time.monotonic()
+        with pytest.raises(subprocess.TimeoutExpired):
+            await adb.shell("sleep 5", timeout=0.3)
+        assert time.monotonic() - start < 2
+
+    asyncio.run(main())
+    assert adb.run_sync(["shell", "echo", "sync"]) == AdbResult(b"sync\n", b"", 0)
+    adb.run_cmd(["shell", "sleep 5"], timeout=0.3)
+    assert adb.get_error() == "timeout" and adb.get_return_code() == 1
+    # what adb printed before the deadline is kept
+    adb.run_cmd(["shell", "echo partial; sleep 5"], timeout=0.5)
+    assert adb.get_output() == b"partial\n" and adb.get_error() == "timeout"
+
+
+class FakeAdbServer(socketserver.ThreadingTCPServer):
+    """
+    Just enough of the adb host protocol for one device, SERIAL. Shell
+    commands run on the host, sync: keeps files in self.files.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0):
+        socketserver.ThreadingTCPServer.__init__(self, ("127.0.0.1", port), FakeAdbHandler)
+        self.forwards = []
+        self.files = {}
+        self.requests = []
+        self.devices = [SERIAL]
+        self.changed = threading.Condition()
+
+    def set_devices(self, devices):
+        with self.changed:
+            self.devices = devices
+            self.changed.notify_all()
+
+    def device_list(self):
+        return "".join("%s device usb:1-1 product:maix\n" % serial for serial in self.devices).encode()
+
+
+SERIAL = "0123456789"
+
+
+class FakeAdbHandler(socketserver.BaseRequestHandler):
+
+    def recv(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    def okay(self, data=None):
+        self.request.sendall(b"OKAY" if data is None else b"OKAY%04x%s" % (len(data), data))
+
+    def fail(self, message):
+        self.request.sendall(b"FAIL%04x%s" % (len(message), message))
+
+    def handle(self):
+        try:
+            while self.serve(self.recv(int(self.recv(4), 16)).decode()):
+                pass
+        except EOFError:
+            pass
+
+    def serve(self, service):
+        server = self.server
+        server.requests.append(service)
+        if service == "host:version":
+            self.okay(b"0029")
+        elif service == "host:devices-l":
+            self.okay(server.device_list())
+        elif service == "host:track-devices-l":
+            self.okay()
+            while True:
+                with server.changed:
+                    devices = server.device_list()
+                    self.request.sendall(b"%04x%s" % (len(devices), devices))
+                    server.changed.wait()
+        elif service == "host:get-serialno":
+            self.okay(SERIAL.encode())
+        elif service == "host:list-forward":
+            self.okay("".join("%s %s %s\n" % fwd for fwd in server.forwards).encode())
+        elif service.startswith(("host:forward:", "host-serial:%s:forward:" % SERIAL)):
+            local, remote = service.split(":forward:")[1].split(";")
+            server.forwards.append((SERIAL, local, remote))
+            self.request.sendall(b"OKAYOKAY")
+        elif service in ("host:transport-any", "host:transport:%s" % SERIAL):
+            self.okay()
+            return True
+        elif service.startswith("host:transport:"):
+            self.fail(b"device '%s' not found" % service[15:].encode())
+        elif service.startswith("shell:"):
+            self.okay()
+            self.request.sendall(subprocess.run(service[6:], shell=True, stdout=subprocess.PIPE).stdout)
+        elif service == "sync:":
+            self.okay()
+            self.sync()
+        else:
+            self.fail(b"unknown host service")
+
+    def sync(self):
+        files = self.server.files
+        while True:
+            sid, length = struct.unpack("<4sI", self.recv(8))
+            data = self.recv(length) if sid != b"DONE" else b""
+            if sid == b"SEND":
+                path, content = data.decode().rsplit(",", 1)[0], b""
+                while True:
+                    sid, length = struct.unpack("<4sI", self.recv(8))
+                    if sid == b"DONE":
+                        break
+                    content += self.recv(length)
+                files[path] = content
+                self.request.sendall(b"OKAY\0\0\0\0")
+            elif sid == b"RECV":
+                path = data.decode()
+                if path not in files:
+                    message = b"No such file or directory"
+                    self.request.sendall(b"FAIL" + struct.pack("<I", len(message)) + message)
+                    continue
+                content = files[path]
+                for i in range(0, len(content), 1000):
+                    chunk = content[i:i + 1000]
+                    self.request.sendall(b"DATA" + struct.pack("<I", len(chunk)) + chunk)
+                self.request.sendall(b"DONE\0\0\0\0")
+            elif sid == b"QUIT":
+                return
+
+
+@pytest.fixture
+def adb_server(monkeypatch):
+    server = FakeAdbServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setenv("ANDROID_ADB_SERVER_PORT", str(server.server_address[1]))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_client(adb_server, tmp_path):
+    client = AdbClient()
+    assert client.version() == 0x29
+    assert client.devices() == [[SERIAL, "device", "usb:1-1", "product:maix"]]
+    assert client.shell("echo hi") == b"hi\n"
+    client.forward("tcp:18812", "tcp:18812", SERIAL)
+    assert client.list_forward() == [(SERIAL, "tcp:18812", "tcp:18812")]
+    with pytest.raises(AdbError, match="not found"):
+        client.shell("true", "nosuchdevice")
+
+    local = tmp_path / "frame.jpg"
+    local.write_bytes(os.urandom(150 * 1024))
+    client.push(str(local), "/root/frame.jpg")
+    assert adb_server.files["/root/frame.jpg"] == local.read_bytes()
+    assert client.pull("/root/frame.jpg", str(tmp_path / "back.jpg")) == 150 * 1024
+    assert (tmp_path / "back.jpg").read_bytes() == local.read_bytes()
+    with pytest.raises(AdbError, match="No such file"):
+        client.pull("/root/missing", str(tmp_path / "missing"))
+
+
+def test_adb_socket_backend(adb_server, tmp_path):
+    # the adb binary must not be needed for anything the socket backend serves
+    adb = ADB(str(tmp_path / "no-adb"), backend="socket")
+    adb.set_target_device(SERIAL)
+    assert adb.run_shell_cmd("echo one two") == b"one two\n"
+    assert adb.connect_check()
+    adb.forward_socket("tcp:18811", "tcp:18811")
+    adb.run_cmd(["forward", "--list"])
+    assert adb.get_output() == b"%s tcp:18811 tcp:18811\n" % SERIAL.encode()
+    adb.run_cmd(["devices", "-l"])
+    assert adb.get_output().decode().splitlines()[1].split()[:2] == [SERIAL, "device"]
+
+    adb.set_target_device("nosuchdevice")
+    assert adb.run_shell_cmd("true") is None
+    assert adb.last_failed()
+
+
+def test_adb_socket_shell_timeout(adb_server, tmp_path):
+    adb = ADB(str(tmp_path / "no-adb"), backend="socket")
+    adb.set_target_device(SERIAL)
+    # quiet for longer than the client's socket timeout: still waited for
+    adb._ADB__client.timeout = 0.5
+    assert adb.run_shell_cmd("sleep 1; echo late") == b"late\n"
+    # a deadline is a failed result, not an exception
+    assert adb.run_shell_cmd("sleep 5", timeout=0.3) is None
+    assert adb.get_error() == "timeout" and adb.last_failed()
+    # the socket timing out under the deadline, same
+    assert adb.__client_result__(["shell", "sleep 1"], 0.2).failed
+
+
+def test_adb_socket_fallback(fake_adb, monkeypatch):
+    # no adb server listening, the adb binary takes over (and would start one)
+    monkeypatch.setenv("ANDROID_ADB_SERVER_PORT", "1")
+    adb = ADB(fake_adb, backend="socket")
+    assert adb.run_shell_cmd(["echo", "fallback"]) == b"fallback\n"
+
+
+def test_forward_manager(adb_server, tmp_path):
+    from rpyc_ikernel.adb import ForwardManager
+    adb_server.forwards.append((SERIAL, "tcp:22", "tcp:22"))
+    adb = ADB(str(tmp_path / "no-adb"), backend="socket")
+    forwards = ForwardManager(adb)
+    wanted = [("tcp:18811", "tcp:18811"), ("tcp:18812", "tcp:18812"), ("tcp:22", "tcp:22")]
+    assert forwards.ensure(wanted) == wanted[:2]
+    assert forwards.ensure(wanted) == []
+    assert sorted(r.split(":", 1)[1] for r in adb_server.requests if "forward" in r) == [
+        "forward:tcp:18811;tcp:18811", "forward:tcp:18812;tcp:18812", "list-forward"]
+    # the adb server restarted without them
+    del adb_server.forwards[:]
+    assert forwards.ensure(wanted) == []
+    forwards.invalidate()
+    assert forwards.ensure(wanted) == wanted
+    assert forwards.forwards() == dict(wanted)
+
+
+def test_stream(fake_adb):
+    adb = ADB(fake_adb)
+    stream = adb.stream(["shell", "seq 1 5000; sleep 30"], maxlen=100)
+    try:
+        deadline = time.monotonic() + 5
+        while stream.received < 5000 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        # nobody read, only the newest maxlen lines are kept
+        lines = stream.read(timeout=1)
+        assert lines == [str(i) for i in range(4901, 5001)]
+        assert stream.dropped == 4900
+        assert stream.read(timeout=0.1) == []
+        assert not stream.closed
+    finally:
+        start = time.monotonic()
+        stream.close()
+        assert time.monotonic() - start < 2
+    assert stream.closed
+
+
+def test_stream_socket(adb_server, tmp_path):
+    adb = ADB(str(tmp_path / "no-adb"), backend="socket")
+    assert list(adb.stream(["shell", "echo a; echo b"])) == ["a", "b"]
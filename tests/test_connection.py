@@ -0,0 +1,106 @@
+"""
+test_connection.py
+
+Check the pooled rpyc connections against a local rpyc classic server.
+
+"""
+
+import socket
+import threading
+import time
+
+import pytest
+from rpyc import SlaveService
+from rpyc.utils.server import ThreadedServer
+
+from rpyc_ikernel.connection import ConnectionPool, race_connect
+
+PORT = 18880
+
+
+@pytest.fixture
+def server():
+    server = ThreadedServer(SlaveService, port=PORT, auto_register=False)
+    server._start_in_thread()
+    yield server
+    server.close()
+
+
+def test_reuse_and_reconnect(server):
+    pool = ConnectionPool('localhost', port=PORT, check_interval=0)
+    control = pool.get('control')
+    assert pool.get('control') is control
+    assert pool.get('exec') is not control
+
+    control.close()
+    again = pool.get('control')
+    assert again is not control
+    assert again.eval('1 + 1') == 2
+
+    pool.close()
+    assert again.closed
+    assert pool.peek('exec') is None
+
+
+def test_address_change_closes(server):
+    pool = ConnectionPool('localhost', port=PORT)
+    conn = pool.get('control')
+    pool.address = '127.0.0.1'
+    assert conn.closed
+    assert pool.get('control').eval('2 * 3') == 6
+    pool.close()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+class Fake():
+
+    def __init__(self, endpoint):
+        self.endpoint, self.closed = endpoint, False
+
+    def close(self):
+        self.closed = True
+
+
+def test_race_connect():
+    made, slow_done = [], threading.Event()
+
+    def connect(endpoint, timeout):
+        if endpoint[0] == 'dead':
+            raise ConnectionRefusedError()
+        if endpoint[0] == 'slow':
+            time.sleep(0.5)
+            made.append(Fake(endpoint))
+            slow_done.set()
+            return made[-1]
+        return Fake(endpoint)
+
+    start = time.monotonic()
+    conn, endpoint = race_connect([('dead', 1), ('slow', 2), ('fast', 3)], stagger=0.1, connect=connect)
+    # a refused attempt starts the next one at once, the slow one gets its stagger
+    assert endpoint == ('fast', 3) and not conn.closed
+    assert time.monotonic() - start < 0.3
+    # the loser is closed when it completes
+    assert slow_done.wait(2) and made[0].closed
+
+    with pytest.raises(ConnectionError):
+        race_connect([('dead', 1), ('dead', 2)], stagger=0.1, connect=connect)
+
+
+def test_pool_candidates(server):
+    dead = ('localhost', free_port())
+    pool = ConnectionPool([dead, ('localhost', PORT)], port=PORT, check_interval=0)
+    assert pool.get('control').eval('1 + 2') == 3
+    assert pool.winner == ('localhost', PORT)
+    assert pool.endpoints() == [('localhost', PORT), dead]
+    assert pool.address == 'localhost'
+
+    # a new set of candidates forgets the winner
+    pool.address = ['127.0.0.1', 'localhost']
+    assert pool.winner is None and pool.endpoints() == [('127.0.0.1', PORT), ('localhost', PORT)]
+    assert pool.get('exec').eval('2 + 2') == 4
+    pool.close()
@@ -0,0 +1,39 @@
+"""
+test_devices.py
+
+Port blocks handed out by the DeviceRegistry.
+
+"""
+
+from rpyc_ikernel.devices import DEFAULT_PORTS, DeviceRegistry
+
+
+def test_registry(tmp_path):
+    path = str(tmp_path / "devices.json")
+    registry = DeviceRegistry(path)
+    first, second = registry.ports("board-a"), registry.ports("board-b")
+    # the classic ports stay with the kernels not pinned to a board
+    assert first.rpyc != DEFAULT_PORTS.rpyc and first.mjpg != DEFAULT_PORTS.mjpg
+    assert (first.mjpg, first.rpyc, first.ssh) == (18821, 18822, 18823)
+    assert first.forwards() == (("tcp:18821", "tcp:18811"), ("tcp:18822", "tcp:18812"), ("tcp:18823", "tcp:22"))
+    assert (second.mjpg, second.rpyc, second.ssh) == (18831, 18832, 18833)
+
+    # another kernel sees the same allocation
+    other = DeviceRegistry(path)
+    assert other.ports("board-b") == second
+    assert other.ports("board-c").mjpg == 18841
+    assert [ports.serial for ports in registry.devices()] == ["board-a", "board-b", "board-c"]
+
+    # a released slot is reused
+    registry.release("board-b")
+    assert registry.ports("board-d") == second._replace(serial="board-d")
+    assert registry.ports("board-a") == first
+
+
+def test_registry_slot_zero(tmp_path):
+    # a file from before slot 0 was reserved
+    path = tmp_path / "devices.json"
+    path.write_text('{"board-a": 0, "board-b": 1}')
+    registry = DeviceRegistry(str(path))
+    assert registry.ports("board-a").rpyc == 18832
+    assert registry.ports("board-b").rpyc == 18822
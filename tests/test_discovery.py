@@ -0,0 +1,84 @@
+"""
+test_discovery.py
+
+Discovery against an rpyc registry and classic servers on loopback.
+
+"""
+
+import socket
+import threading
+import time
+
+import pytest
+from rpyc import SlaveService
+from rpyc.utils.registry import UDPRegistryClient, UDPRegistryServer
+from rpyc.utils.server import ThreadedServer
+
+from rpyc_ikernel.discovery import Discovery, EndpointCache, query_registry
+
+
+def free_port(kind=socket.SOCK_STREAM):
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def registry():
+    server = UDPRegistryServer("127.0.0.1", free_port(socket.SOCK_DGRAM))
+    threading.Thread(target=server.start, daemon=True).start()
+    yield server
+    server.close()
+
+
+def board(registry=None):
+    port = free_port()
+    registrar = UDPRegistryClient("127.0.0.1", registry.port, timeout=1) if registry else None
+    server = ThreadedServer(SlaveService, hostname="127.0.0.1", port=port,
+                            registrar=registrar, auto_register=registry is not None)
+    server._start_in_thread()
+    return server
+
+
+def test_discover(registry, tmp_path):
+    boards = [board(registry), board(registry)]
+    try:
+        deadline = time.monotonic() + 5
+        while len(query_registry("127.0.0.1", registry.port, timeout=0.5)) < 2:
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+
+        cache = EndpointCache(str(tmp_path / "endpoints.json"))
+        silent = ("127.0.0.1", free_port())
+        discovery = Discovery("127.0.0.1", registry.port, timeout=0.5, cache=cache)
+        found = discovery.discover([silent])
+        ports = sorted(e.port for e in found if e.reachable)
+        assert ports == sorted(b.port for b in boards)
+        # reachable first, by round-trip
+        assert [e.reachable for e in found] == [True, True, False]
+        assert found[0].rtt <= found[1].rtt
+        assert discovery.best().port in ports
+
+        # remembered without a registry, the silent one was not cached
+        assert sorted(e.port for e in cache.endpoints()) == ports
+        boards[0].close()
+        found = Discovery(None, cache=cache, timeout=0.5).discover()
+        assert [(e.port, e.reachable) for e in found] == [(boards[1].port, True), (boards[0].port, False)]
+    finally:
+        for b in boards:
+            b.close()
+
+
+def test_cache_max_age(tmp_path):
+    server = board()
+    try:
+        cache = EndpointCache(str(tmp_path / "endpoints.json"), max_age=60)
+        found = Discovery(None, cache=cache, timeout=0.5).discover([("127.0.0.1", server.port)])
+        assert found[0].reachable and len(cache.endpoints()) == 1
+        cache.max_age = -1
+        assert cache.endpoints() == []
+        cache.max_age = 60
+        cache.forget("127.0.0.1", server.port)
+        assert cache.endpoints() == []
+    finally:
+        server.close()
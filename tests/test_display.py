@@ -0,0 +1,239 @@
+"""
+test_display.py
+
+Check the frame buffering used by the display pipeline.
+
+"""
+
+import base64
+import io
+import logging
+import socketserver
+import threading
+import time
+
+from PIL import Image
+
+from rpyc_ikernel.display import DisplaySession, FrameSlot, FrameTransform, transform_frame
+from rpyc_ikernel.kernel import RPycKernel
+from rpyc_ikernel.metrics import Metrics
+from rpyc_ikernel.mjpg import BufferPool
+
+
+def test_latest_frame_wins():
+    slot = FrameSlot()
+    for i in range(5):
+        slot.put(i)
+    assert slot.get(timeout=0) == 4
+    assert slot.get(timeout=0) is None
+    assert slot.stats() == {'received': 5, 'published': 1, 'dropped': 4}
+
+
+def test_get_wakes_on_put_and_close():
+    slot = FrameSlot()
+    threading.Timer(0.05, slot.put, args=(b'frame', )).start()
+    assert slot.get(timeout=5) == b'frame'
+
+    threading.Timer(0.05, slot.close).start()
+    assert slot.get(timeout=5) is None
+    assert slot.closed
+
+
+def make_jpeg(size=(640, 480)):
+    buf = io.BytesIO()
+    Image.new('RGB', size, (30, 120, 200)).save(buf, format='JPEG', quality=95)
+    return buf.getvalue()
+
+
+def test_transform_frame():
+    data = transform_frame(make_jpeg(), max_width=320, quality=50)
+    assert Image.open(io.BytesIO(data)).size == (320, 240)
+    # smaller than max_width is left at its size
+    data = transform_frame(make_jpeg((160, 120)), max_width=320)
+    assert Image.open(io.BytesIO(data)).size == (160, 120)
+
+
+def test_frame_transform_pool():
+    transform = FrameTransform(max_width=200, quality=60, workers=1)
+    try:
+        data = transform(memoryview(make_jpeg()), timeout=60)
+    finally:
+        transform.shutdown()
+    assert Image.open(io.BytesIO(data)).size == (200, 150)
+
+
+class ShortStream(socketserver.StreamRequestHandler):
+    """MJPEG server that hangs up after a few frames."""
+
+    def handle(self):
+        while self.rfile.readline() not in (b'\r\n', b''):
+            pass
+        self.wfile.write(b'HTTP/1.0 200 OK\r\n'
+                         b'Content-Type: multipart/x-mixed-replace; boundary=--frame\r\n\r\n')
+        for i in range(5):
+            jpeg = b'\xff\xd8' + bytes([i]) * 100 + b'\xff\xd9'
+            self.wfile.write(b'\r\n--frame\r\nContent-Type: image/jpeg\r\n'
+                             b'Content-Length: %d\r\n\r\n' % len(jpeg) + jpeg)
+            time.sleep(0.01)
+
+
+def test_display_session_reconnects():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), ShortStream)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    session = DisplaySession('http://127.0.0.1:%d' % server.server_address[1], backoff=0.01)
+    slot = FrameSlot()
+    session.attach(slot)
+    session.start()
+    try:
+        deadline = time.time() + 10
+        while session.connects < 3 and time.time() < deadline:
+            assert slot.get(timeout=1) is not None
+    finally:
+        session.close()
+        server.shutdown()
+        server.server_close()
+    assert session.connects >= 3
+    assert slot.closed
+
+
+class NoFrames(socketserver.StreamRequestHandler):
+    """MJPEG server that hangs up right after the headers."""
+
+    def handle(self):
+        while self.rfile.readline() not in (b'\r\n', b''):
+            pass
+        self.wfile.write(b'HTTP/1.0 200 OK\r\n'
+                         b'Content-Type: multipart/x-mixed-replace; boundary=--frame\r\n\r\n')
+
+
+def test_display_session_backs_off_empty_streams():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), NoFrames)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    session = DisplaySession('http://127.0.0.1:%d' % server.server_address[1], backoff=0.05, max_backoff=0.4)
+    session.start()
+    try:
+        time.sleep(1)
+    finally:
+        session.close()
+        server.shutdown()
+        server.server_close()
+    # 0.05, 0.1, 0.2, 0.4, 0.4... with jitter: a handful, not thousands
+    assert 2 <= session.connects <= 10
+    assert session.failures >= session.connects - 1
+
+
+class Outputs():
+    '''
+    Stands in for the kernel's send_response and the frame comm: records
+    what the front end would get and puts the next frame in the slot after
+    each one shown, the preview ends once frames runs out.
+    '''
+
+    def __init__(self, kernel, slot, frames):
+        self.kernel, self.slot, self.frames = kernel, slot, list(frames)
+        self.messages, self.sent = [], []
+        self.feed()
+
+    def feed(self):
+        if self.frames:
+            self.slot.put(self.frames.pop(0))
+        else:
+            self.kernel._media_work = False
+
+    def __call__(self, stream, msg_type, content):
+        self.messages.append((msg_type, content))
+        if any(mimetype.startswith('image/') for mimetype in content.get('data', {})):
+            self.feed()
+
+    def send(self, data, buffers):
+        self.sent.append((data, buffers))
+        self.feed()
+
+
+def preview_kernel(version='5.3'):
+    # just the preview plumbing, no ipykernel session
+    kernel = RPycKernel.__new__(RPycKernel)
+    kernel.log = logging.getLogger("rpyc_ikernel")
+    kernel.update_display, kernel.clear_output = True, True
+    kernel.frame_transform, kernel._frame_comm = None, None
+    kernel._media_pool, kernel._media_port, kernel._media_work = BufferPool(), 18811, True
+    kernel.iopub_socket, kernel.metrics = None, Metrics()
+    kernel.get_parent = lambda: {'header': {'version': version}}
+    return kernel
+
+
+def preview(kernel, frames, display_id=None, frame_comm=None):
+    slot = FrameSlot()
+    outputs = Outputs(kernel, slot, frames)
+    kernel.send_response = outputs
+    if frame_comm is not None:
+        frame_comm.outputs = outputs
+    kernel._update_display(slot, display_id, frame_comm)
+    assert slot.closed
+    return outputs
+
+
+def test_supports_update_display():
+    assert preview_kernel('5.3')._supports_update_display()
+    assert preview_kernel('5.1')._supports_update_display()
+    assert not preview_kernel('5.0')._supports_update_display()
+    kernel = preview_kernel('5.3')
+    kernel.update_display = False
+    assert not kernel._supports_update_display()
+
+
+def test_update_display():
+    frames = [make_jpeg((32, 24)), make_jpeg((64, 48)), make_jpeg((16, 12))]
+    kernel = preview_kernel()
+    outputs = preview(kernel, frames, 'abc')
+    assert kernel.metrics.json()['frames_sent_total'] == 3
+    # one output, later frames replace its data
+    assert [msg_type for msg_type, _ in outputs.messages] == \
+        ['display_data', 'update_display_data', 'update_display_data']
+    for (_, content), frame in zip(outputs.messages, frames):
+        assert content['transient'] == {'display_id': 'abc'}
+        assert base64.b64decode(content['data']['image/jpeg']) == frame
+
+
+def test_update_display_old_frontend():
+    # no display_id below protocol 5.1: a new output per frame, the old one cleared
+    frames = [make_jpeg((32, 24)), make_jpeg((16, 12))]
+    outputs = preview(preview_kernel('5.0'), frames)
+    assert [msg_type for msg_type, _ in outputs.messages] == \
+        ['clear_output', 'display_data', 'clear_output', 'display_data']
+    assert all('transient' not in content for _, content in outputs.messages)
+    assert base64.b64decode(outputs.messages[-1][1]['data']['image/jpeg']) == frames[-1]
+
+
+class FrameComm():
+
+    def send(self, data, buffers):
+        self.outputs.send(data, buffers)
+
+
+def test_update_display_comm():
+    frames = [make_jpeg((32, 24)), make_jpeg((16, 12))]
+    kernel = preview_kernel()
+    comm = kernel._frame_comm = FrameComm()
+    outputs = preview(kernel, frames, frame_comm=comm)
+    # a placeholder output, then the raw jpegs over the comm, no base64
+    assert [msg_type for msg_type, _ in outputs.messages] == ['display_data']
+    display_id = outputs.messages[0][1]['transient']['display_id']
+    assert display_id and 'text/html' in outputs.messages[0][1]['data']
+    assert [data for data, _ in outputs.sent] == [{'display_id': display_id, 'mimetype': 'image/jpeg'}] * 2
+    assert [buffers for _, buffers in outputs.sent] == [[frame] for frame in frames]
+    sent = kernel.metrics.json()
+    assert sent['frames_sent_total'] == 2 and sent['frame_bytes_sent_total'] == sum(map(len, frames))
+
+
+def test_update_display_comm_closed():
+    # the comm went away (page reloaded): back to base64 in the same output
+    frames = [make_jpeg((32, 24)), make_jpeg((16, 12))]
+    kernel = preview_kernel()
+    outputs = preview(kernel, frames, 'abc', frame_comm=FrameComm())
+    assert not outputs.sent
+    assert [msg_type for msg_type, _ in outputs.messages] == ['display_data', 'update_display_data']
+    assert all(content['transient'] == {'display_id': 'abc'} for _, content in outputs.messages)
+    assert base64.b64decode(outputs.messages[0][1]['data']['image/jpeg']) == frames[0]
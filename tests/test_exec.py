@@ -0,0 +1,131 @@
+"""
+test_exec.py
+
+The kernel's exec connection against a local rpyc classic server whose
+threads get reaped, as after an interrupted cell.
+
+"""
+
+import logging
+import re
+import subprocess
+import sys
+import threading
+import time
+import types
+
+import pytest
+import rpyc
+
+from rpyc_ikernel.connection import ConnectionPool
+from rpyc_ikernel.kernel import RPycKernel
+from rpyc_ikernel.metrics import Metrics
+from rpyc_ikernel.remote import install
+from rpyc_ikernel.stats import PhaseTimer
+
+PORT = 18883
+
+
+@pytest.fixture
+def server():
+    # a separate process, reap_threads would otherwise hit pytest's own threads
+    server = subprocess.Popen([sys.executable, '-c',
+        'from rpyc.utils.server import ThreadedServer; from rpyc import SlaveService; '
+        'ThreadedServer(SlaveService, port=%d, auto_register=False).start()' % PORT])
+    for _ in range(50):
+        try:
+            rpyc.classic.connect("localhost", port=PORT).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    yield server
+    server.kill()
+    server.wait()
+
+
+@pytest.fixture
+def kernel(server):
+    # just the exec plumbing, no ipykernel session
+    kernel = RPycKernel.__new__(RPycKernel)
+    kernel.log = logging.getLogger("rpyc_ikernel")
+    kernel.channels = ConnectionPool('localhost', PORT, check_interval=0)
+    kernel._exec_lock, kernel._executing = threading.Lock(), False
+    kernel.remote = None
+    kernel.stdio_buffer, kernel.stdio_interval, kernel._stdio = 4096, 0.05, None
+    kernel._open_exec()
+    yield kernel
+    kernel.channels.close()
+
+
+def reap_exec(kernel):
+    # what kill_task(interrupted=True) does to the board
+    install(kernel.channels.get('control'))['reap_threads'](())
+    time.sleep(0.2)
+    # the host has not read the close yet
+    assert not kernel.remote.closed
+
+
+def test_background_reconnect(kernel):
+    stale = kernel.remote
+    reap_exec(kernel)
+    kernel._background_reconnect(True)
+    assert kernel.remote is not stale and stale.closed
+    assert kernel.remote.eval('1 + 1') == 2
+
+    # the board stopped answering the heartbeat, exec goes as well
+    kernel._background_reconnect(False)
+    assert kernel.remote is None and kernel.channels.peek('exec') is None
+    kernel._background_reconnect(True)
+    assert kernel.remote.eval('2 + 2') == 4
+
+
+def test_submit_resends_once(kernel):
+    stale = kernel.remote
+    reap_exec(kernel)
+    result = kernel._submit('x = 6 * 7')
+    result.wait()
+    assert kernel.remote is not stale
+    assert kernel.remote.modules.builtins.globals()['x'] == 42
+
+
+def test_interrupt_drops_exec(kernel):
+    kernel._reaper, kernel._reaper_conn = None, None
+    kernel._media_work, kernel._media_session, kernel._media_slot = False, None, None
+    stale = kernel.remote
+    kernel.kill_task(interrupted=True)
+    assert kernel.remote is None and stale.closed
+    kernel._background_reconnect(True)
+    assert kernel.remote.eval('3 + 3') == 6
+
+
+def test_log_closed_when_not_connected():
+    kernel = RPycKernel.__new__(RPycKernel)
+    kernel.log = logging.getLogger("rpyc_ikernel")
+    kernel.pattern = re.compile("[$](.*?)[(](.*)[)]")
+    kernel.commands = {'log': 'self.attach_log(%s)'}
+    kernel.timer, kernel.profiling, kernel.metrics = PhaseTimer(), False, Metrics()
+    kernel._log_stream = None
+    closed = []
+    kernel.attach_log = lambda cmd: setattr(kernel, '_log_stream', types.SimpleNamespace(close=lambda: closed.append(cmd)))
+    # no board: the cell never runs, the log it asked for must not outlive it
+    kernel.check_connect = lambda: False
+    kernel.do_execute("$log('logcat')\nprint(1)", False)
+    assert kernel._log_stream is None and closed == ['logcat']
+
+
+def test_heartbeat_leaves_a_started_cell_alone(kernel):
+    kernel.heartbeat = types.SimpleNamespace(alive=True, dead=False)
+    assert kernel.check_connect() and kernel._executing
+    # a dead beat between the check and the submit
+    remote = kernel.remote
+    kernel._background_reconnect(False)
+    assert kernel.remote is remote
+    kernel._executing = False
+
+
+def test_submit_without_exec(kernel):
+    # exec dropped after the check: reconnect instead of remote.modules on None
+    kernel._drop_exec()
+    result = kernel._submit('y = 7')
+    result.wait()
+    assert kernel.remote.modules.builtins.globals()['y'] == 7
@@ -0,0 +1,79 @@
+"""
+test_health.py
+
+The service probes against local stand-ins for the board.
+
+"""
+
+import http.server
+import socket
+import threading
+
+import pytest
+import rpyc
+from rpyc.utils.server import ThreadedServer
+
+from rpyc_ikernel.devices import DevicePorts
+from rpyc_ikernel.health import HealthChecker, probe_http, probe_rpyc, probe_tcp
+
+
+def closing_server():
+    # accepts and hangs up straight away, like adb forward to a dead port
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(8)
+
+    def serve():
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                return
+            conn.close()
+    threading.Thread(target=serve, daemon=True).start()
+    return server
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def services():
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), http.server.BaseHTTPRequestHandler)
+    rpycd = ThreadedServer(rpyc.Service, hostname="127.0.0.1", port=0, auto_register=False)
+    for target in (httpd.serve_forever, rpycd.start):
+        threading.Thread(target=target, daemon=True).start()
+    yield DevicePorts("board", httpd.server_address[1], rpycd.port, free_port())
+    httpd.shutdown()
+    httpd.server_close()
+    rpycd.close()
+
+
+def test_probes(services):
+    dead, closing = free_port(), closing_server()
+    hangup = closing.getsockname()[1]
+    try:
+        assert probe_tcp("127.0.0.1", services.rpyc)
+        assert not probe_tcp("127.0.0.1", dead)
+        assert not probe_tcp("127.0.0.1", hangup)
+        # BaseHTTPRequestHandler has no do_HEAD, the 501 still counts
+        assert probe_http("127.0.0.1", services.mjpg)
+        assert not probe_http("127.0.0.1", services.rpyc, timeout=0.2)
+        assert not probe_http("127.0.0.1", hangup)
+        assert probe_rpyc("127.0.0.1", services.rpyc)
+        assert not probe_rpyc("127.0.0.1", services.mjpg, timeout=0.2)
+        assert not probe_rpyc("127.0.0.1", dead)
+    finally:
+        closing.close()
+
+
+def test_checker(services):
+    health = HealthChecker("127.0.0.1", services)
+    assert health.check() == {"mjpg": True, "rpyc": True}
+    assert health.ok(deep=False)
+    down = HealthChecker("127.0.0.1", services._replace(rpyc=free_port()))
+    assert down.check() == {"mjpg": True, "rpyc": False}
+    assert not down.ok()
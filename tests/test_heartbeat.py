@@ -0,0 +1,77 @@
+"""
+test_heartbeat.py
+
+Heartbeat against a local rpyc classic server that goes away and comes back.
+
+"""
+
+import time
+
+from rpyc import SlaveService
+from rpyc.utils.server import ThreadedServer
+
+from rpyc_ikernel.connection import ConnectionPool
+from rpyc_ikernel.heartbeat import Heartbeat
+
+PORT = 18881
+
+
+def start_server():
+    server = ThreadedServer(SlaveService, port=PORT, auto_register=False)
+    server._start_in_thread()
+    return server
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+def test_heartbeat():
+    server = start_server()
+    pool = ConnectionPool('localhost', port=PORT, check_interval=0)
+    beats = []
+    heartbeat = Heartbeat(pool, interval=0.1, timeout=0.5, on_beat=beats.append).start()
+    try:
+        assert wait_for(lambda: heartbeat.alive)
+        assert 0 < heartbeat.rtt < 0.5
+        assert beats[-1] is True
+
+        server.close()
+        pool.peek('control').close()
+        assert wait_for(lambda: heartbeat.dead)
+        assert beats[-1] is False and heartbeat.failures
+
+        # back in the background, nobody asked for a connection
+        server = start_server()
+        assert wait_for(lambda: heartbeat.alive)
+        assert not pool.peek('control').closed
+    finally:
+        heartbeat.stop()
+        pool.close()
+        server.close()
+    # an old answer is not acted upon
+    time.sleep(0.3)
+    assert not heartbeat.alive and not heartbeat.dead
+
+
+def test_set_interval():
+    pool = ConnectionPool('localhost', port=PORT)
+    heartbeat = Heartbeat(pool, interval=60, timeout=0.1)
+    heartbeat.set_interval(0.05)
+    assert heartbeat._scheduler is None
+    heartbeat.start()
+    try:
+        # the first beat runs at once, the next ones on the new interval
+        assert wait_for(lambda: heartbeat.beats >= 3, timeout=2)
+        heartbeat.set_interval(60)
+        beats = heartbeat.beats
+        time.sleep(0.3)
+        assert heartbeat.beats <= beats + 1 and heartbeat.interval == 60
+    finally:
+        heartbeat.stop()
+        pool.close()
@@ -0,0 +1,78 @@
+"""
+test_metrics.py
+
+The metrics registry and its two exports.
+
+"""
+
+import json
+import types
+import urllib.request
+
+from rpyc_ikernel.kernel import RPycKernel
+from rpyc_ikernel.metrics import Metrics, MetricsFile, Sample, export
+
+
+def test_metrics():
+    metrics = Metrics()
+    metrics.inc('cells_total', help='cells executed')
+    metrics.inc('cells_total', 2)
+    metrics.set('queue', 3, help='queued')
+    metrics.add_collector(lambda: [Sample('rtt_seconds', 'gauge', 'ping', 0.25),
+                                   Sample('unknown', 'gauge', '', None)])
+
+    def broken():
+        raise RuntimeError()
+    metrics.add_collector(broken)
+
+    assert metrics.json() == {'cells_total': 3, 'queue': 3, 'rtt_seconds': 0.25, 'unknown': None}
+    assert metrics.prometheus().splitlines() == [
+        '# HELP rpyc_ikernel_cells_total cells executed',
+        '# TYPE rpyc_ikernel_cells_total counter',
+        'rpyc_ikernel_cells_total 3.0',
+        '# HELP rpyc_ikernel_queue queued',
+        '# TYPE rpyc_ikernel_queue gauge',
+        'rpyc_ikernel_queue 3.0',
+        '# HELP rpyc_ikernel_rtt_seconds ping',
+        '# TYPE rpyc_ikernel_rtt_seconds gauge',
+        'rpyc_ikernel_rtt_seconds 0.25',
+    ]
+
+
+def test_export(tmp_path):
+    metrics = Metrics()
+    metrics.inc('frames_total', 5)
+
+    server = export(metrics, 0)
+    try:
+        with urllib.request.urlopen('http://127.0.0.1:%d/metrics' % server.port, timeout=5) as response:
+            assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+            assert 'rpyc_ikernel_frames_total 5.0' in response.read().decode()
+    finally:
+        server.stop()
+
+    path = str(tmp_path / 'kernel.json')
+    writer = export(metrics, path, interval=60)
+    assert isinstance(writer, MetricsFile)
+    with open(path) as f:
+        assert json.load(f) == {'frames_total': 5}
+    metrics.inc('frames_total')
+    writer.stop()
+    with open(path) as f:
+        assert json.load(f) == {'frames_total': 6}
+
+
+def test_iopub_messages():
+    # prints go to the IOPubThread, displays, status and comm frames to the socket in front of it
+    kernel = RPycKernel.__new__(RPycKernel)
+    kernel.metrics = Metrics()
+    kernel.iopub_socket = types.SimpleNamespace(io_thread=object())
+    sent = []
+    session = types.SimpleNamespace(send=lambda stream, msg_type, *args, **kwargs: sent.append(msg_type))
+    kernel._count_iopub(session)
+    session.send(kernel.iopub_socket, 'status')
+    session.send(kernel.iopub_socket.io_thread, 'stream')
+    session.send(kernel.iopub_socket, 'comm_msg', buffers=[b'jpeg'])
+    session.send(object(), 'execute_reply')
+    assert sent == ['status', 'stream', 'comm_msg', 'execute_reply']
+    assert kernel.metrics.json() == {'iopub_messages_total': 3}
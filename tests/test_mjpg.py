@@ -0,0 +1,83 @@
+"""
+test_mjpg.py
+
+Check the buffered MJPEG parser against synthetic multipart streams.
+
+"""
+
+import io
+
+import pytest
+
+from rpyc_ikernel.mjpg import BufferPool, MjpgStream, ProtoError
+
+BOUNDARY = '--boundarydonotcross'
+
+
+def make_frame(i, size=1000):
+    return b'\xff\xd8' + bytes([i % 256]) * size + b'\xff\xd9'
+
+
+def make_stream(frames, content_length=True):
+    out = io.BytesIO()
+    for frame in frames:
+        out.write(b'\r\n' + BOUNDARY.encode() + b'\r\nContent-Type: image/jpeg\r\n')
+        if content_length:
+            out.write(b'Content-Length: %d\r\n' % len(frame))
+        out.write(b'\r\n' + frame)
+    out.write(b'\r\n' + BOUNDARY.encode() + b'\r\nContent-Length: 0\r\n\r\n')
+    out.seek(0)
+    return out
+
+
+class Trickle(io.RawIOBase):
+    """Hands out at most a few bytes per read, like a slow socket."""
+
+    def __init__(self, data, step=7):
+        self.data, self.pos, self.step = data, 0, step
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), self.step, len(self.data) - self.pos)
+        b[:n] = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+
+def read_all(parser):
+    frames = []
+    with pytest.raises(EOFError):
+        for frame in parser.iter_content():
+            frames.append(bytes(frame))
+            parser.release(frame)
+    return frames
+
+
+@pytest.mark.parametrize('content_length', [True, False])
+def test_frames(content_length):
+    frames = [make_frame(i, 1000 + i) for i in range(20)]
+    parser = MjpgStream(make_stream(frames, content_length), BOUNDARY)
+    assert read_all(parser) == frames
+
+
+def test_small_reads_and_small_buffer():
+    frames = [make_frame(i, 3000) for i in range(5)]
+    stream = Trickle(make_stream(frames).getvalue())
+    parser = MjpgStream(stream, BOUNDARY, bufsize=64)
+    assert read_all(parser) == frames
+
+
+def test_buffers_are_recycled():
+    frames = [make_frame(i) for i in range(50)]
+    pool = BufferPool()
+    parser = MjpgStream(make_stream(frames), BOUNDARY, pool=pool)
+    read_all(parser)
+    assert pool.allocations == 1
+
+
+def test_bad_content_length():
+    stream = io.BytesIO(b'\r\n' + BOUNDARY.encode() + b'\r\nContent-Length: abc\r\n\r\n')
+    with pytest.raises(ProtoError):
+        MjpgStream(stream, BOUNDARY).read_frame()
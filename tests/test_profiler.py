@@ -0,0 +1,54 @@
+"""
+test_profiler.py
+
+Count the rpyc traffic of connections to a local rpyc classic server.
+
+"""
+
+import io
+
+import pytest
+from rpyc import SlaveService
+from rpyc.utils.server import ThreadedServer
+
+from rpyc_ikernel.connection import ConnectionPool
+from rpyc_ikernel.profiler import CountingStream, RpycProfiler
+from rpyc_ikernel.remote import install
+
+PORT = 18882
+
+
+@pytest.fixture
+def server():
+    server = ThreadedServer(SlaveService, port=PORT, auto_register=False)
+    server._start_in_thread()
+    yield server
+    server.close()
+
+
+def test_profiler(server):
+    profiler = RpycProfiler()
+    pool = ConnectionPool('localhost', port=PORT, on_connect=profiler.attach)
+    conn = pool.get('exec')
+    stdio = install(conn)['install_stdio'](io.StringIO(), io.StringIO(), 4096, 60)
+
+    profiler.reset()
+    assert conn.modules.os.getpid() > 0
+    conn.execute("print('x')")
+    stdio.flush()
+    traffic = profiler.traffic['exec']
+    assert traffic.requests['getattr'] >= 1 and traffic.requests['call'] >= 2
+    assert traffic.sync == sum(traffic.requests.values()) - traffic.requests['del']
+    assert traffic.wait > 0 and traffic.sent > 0 and traffic.received > 0
+    # the buffered print came back as one-way write/flush requests
+    assert traffic.served['call'] == 2
+    assert profiler.report()[0].startswith('rpyc exec: ')
+
+    profiler.reset()
+    profiler.detach(conn)
+    assert 'sync_request' not in conn.__dict__
+    assert not isinstance(conn._channel.stream, CountingStream)
+    assert conn.eval('1 + 1') == 2
+    assert not profiler.traffic
+    stdio.close()
+    pool.close()
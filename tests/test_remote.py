@@ -0,0 +1,99 @@
+"""
+test_remote.py
+
+Check the board side helpers against a local rpyc classic server.
+
+"""
+
+import io
+import subprocess
+import sys
+import time
+
+import pytest
+import rpyc
+
+from rpyc_ikernel.remote import install
+
+
+class Recorder(io.StringIO):
+
+    def __init__(self, name, log):
+        io.StringIO.__init__(self)
+        self.name, self.log = name, log
+
+    def write(self, data):
+        self.log.append((self.name, data))
+        return io.StringIO.write(self, data)
+
+
+@pytest.fixture
+def conn():
+    # a separate process, reap_threads would otherwise hit pytest's own threads
+    server = subprocess.Popen([sys.executable, '-c',
+        'from rpyc.utils.server import ThreadedServer; from rpyc import SlaveService; '
+        'ThreadedServer(SlaveService, port=18879, auto_register=False).start()'])
+    for _ in range(50):
+        try:
+            conn = rpyc.classic.connect("localhost", port=18879)
+            break
+        except OSError:
+            time.sleep(0.1)
+    yield conn
+    conn.close()
+    server.kill()
+    server.wait()
+
+
+def test_buffered_stdio(conn):
+    log = []
+    stdout, stderr = Recorder('out', log), Recorder('err', log)
+    stdio = install(conn)['install_stdio'](stdout, stderr, 4096, 60)
+    conn.execute("import sys\nfor i in range(500): print(i)\n"
+                 "print('oops', file=sys.stderr)\nprint('done')")
+    stdio.flush()
+
+    assert stdout.getvalue() == ''.join('%d\n' % i for i in range(500)) + 'done\n'
+    assert stderr.getvalue() == 'oops\n'
+    # a handful of chunks rather than a round-trip per print
+    assert len(log) < 10
+    assert [name for name, _ in log][-2:] == ['err', 'out']
+    stdio.close()
+
+
+def test_reap_threads(conn):
+    ns = install(conn)
+    conn.execute(
+        "import threading, time\n"
+        "def spin():\n"
+        "    try:\n"
+        "        while True: time.sleep(0.01)\n"
+        "    except KeyboardInterrupt:\n"
+        "        pass\n"
+        "workers = [threading.Thread(target=spin, name='worker%d' % i) for i in range(3)]\n"
+        "for t in workers: t.start()\n")
+    keep = conn.namespace['workers'][0].ident
+    stopped = ns['reap_threads']((keep, ))
+    assert isinstance(stopped, tuple)
+    assert sorted(name for _, name in stopped if name.startswith('worker')) == ['worker1', 'worker2']
+    conn.execute("for t in workers[1:]: t.join(5)")
+    assert conn.eval("tuple(t.is_alive() for t in workers)") == (True, False, False)
+    # clean up the one that was kept
+    ns['reap_threads'](())
+
+
+def test_flush_while_flusher_writes(conn):
+    # the flusher thread shipping a chunk must not block the host's flush()
+    out = []
+    stdout = Recorder('out', out)
+    stdio = install(conn)['install_stdio'](stdout, stdout, 4096, 0.001)
+    start = time.monotonic()
+    for i in range(20):
+        conn.execute("print(%d)" % i)
+        stdio.flush()
+    conn.execute("print('done')")
+    stdio.flush()
+    conn.ping()
+    assert time.monotonic() - start < 5
+    assert stdout.getvalue() == ''.join('%d\n' % i for i in range(20)) + 'done\n'
+    stdio.close()
@@ -0,0 +1,59 @@
+"""
+test_startup.py
+
+Kernel startup: importing the kernel must not pull in rpyc, PIL or talk to
+adb, and the time from process start to the first kernel_info_reply stays
+within STARTUP_BUDGET seconds (RPYC_IKERNEL_STARTUP_BUDGET to override).
+
+    python tests/test_startup.py   # prints the startup time
+
+"""
+
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STARTUP_BUDGET = float(os.environ.get("RPYC_IKERNEL_STARTUP_BUDGET", 10))
+
+
+def test_lazy_imports():
+    code = ("import sys, rpyc_ikernel.kernel, rpyc_ikernel.adb as adb; "
+            "print([m for m in ('rpyc', 'PIL', 'imghdr') if m in sys.modules], adb._devices)")
+    out = subprocess.check_output([sys.executable, "-c", code], cwd=ROOT, env=dict(os.environ, PYTHONPATH=ROOT))
+    assert out.decode().split() == ["[]", "{}"]
+
+
+def startup_time():
+    from jupyter_client import KernelManager
+    from jupyter_client.kernelspec import KernelSpec
+    km = KernelManager()
+    km._kernel_spec = KernelSpec(argv=[sys.executable, "-m", "rpyc_ikernel", "-f", "{connection_file}"],
+                                 display_name="RPyc", language="python", env={"PYTHONPATH": ROOT})
+    start = time.perf_counter()
+    km.start_kernel()
+    kc = km.client()
+    kc.start_channels()
+    try:
+        kc.kernel_info()
+        reply = kc.get_shell_msg(timeout=60)
+        assert reply["msg_type"] == "kernel_info_reply"
+        return time.perf_counter() - start
+    finally:
+        kc.stop_channels()
+        km.shutdown_kernel(now=True)
+
+
+def test_startup_time():
+    pytest.importorskip("jupyter_client")
+    elapsed = startup_time()
+    print("kernel_info_reply after %.2fs" % elapsed)
+    assert elapsed < STARTUP_BUDGET
+
+
+if __name__ == "__main__":
+    print("kernel_info_reply after %.2fs" % startup_time())
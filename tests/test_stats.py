@@ -0,0 +1,54 @@
+"""
+test_stats.py
+
+Check the per cell phase timings.
+
+"""
+
+import time
+
+from rpyc_ikernel.stats import PhaseTimer, percentile
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile(values, 100) == 100
+    assert percentile(values, 0) == 1
+    assert percentile([3], 90) == 3
+    assert percentile([], 50) is None
+
+
+def test_phase_timer():
+    timer = PhaseTimer(history=3)
+    for i in range(5):
+        timer.begin()
+        with timer.phase('connect'):
+            time.sleep(0.001)
+        with timer.phase('wait'):
+            time.sleep(0.001 * i)
+        with timer.phase('wait'):
+            pass
+        record = timer.end()
+        assert list(record) == ['connect', 'wait', 'total']
+        assert record['total'] >= record['connect'] + record['wait']
+        assert timer.last is record
+    assert len(timer.history) == 3
+    assert timer.end() is None
+
+    summary = timer.percentiles()
+    assert list(summary) == ['connect', 'wait', 'total']
+    assert summary['wait']['n'] == 3 and summary['wait']['max'] >= 0.004
+    assert summary['wait'][50] <= summary['wait'][90] <= summary['wait']['max']
+
+    report = timer.report().splitlines()
+    assert report[0].split() == ['phase', 'n', 'p50', 'p90', 'p99', 'max']
+    assert [line.split()[0] for line in report[1:]] == ['connect', 'wait', 'total']
+
+    # a phase outside of a cell is not recorded
+    timer.begin()
+    timer.last = None
+    with timer.phase('handle'):
+        pass
+    assert timer.end()['handle'] >= 0
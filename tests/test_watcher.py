@@ -0,0 +1,113 @@
+"""
+test_watcher.py
+
+DeviceWatcher against the fake adb server, with a local listener standing
+in for the board's services.
+
+"""
+
+import socket
+import threading
+import time
+
+from rpyc_ikernel.adb_client import AdbClient
+from rpyc_ikernel.health import probe_tcp
+from rpyc_ikernel.watcher import DeviceWatcher
+
+from test_adb import SERIAL, FakeAdbServer, adb_server  # noqa: F401 (fixture)
+
+
+class Service():
+
+    def __init__(self):
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(8)
+        self.port = self.sock.getsockname()[1]
+        self.running = False
+        self.deep = 0
+
+    def start(self):
+        self.sock.listen(8)
+        self.running = True
+
+    def stop(self):
+        # connections are refused, the port stays reserved for start()
+        self.running = False
+        self.sock.close()
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", self.port))
+
+    def ok(self, deep=True):
+        # stands in for the HealthChecker
+        self.deep += deep
+        return probe_tcp("127.0.0.1", self.port)
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+def test_watcher(adb_server):
+    adb_server.set_devices([])
+    service = Service()
+    service.stop()
+    events = []
+    watcher = DeviceWatcher(service.start, health=service,
+                            probe_interval=0.1, retry_interval=0.1, on_device=events.append).start()
+    try:
+        time.sleep(0.3)
+        assert watcher.state == "offline" and watcher.binds == 0
+
+        adb_server.set_devices([SERIAL])
+        assert wait_for(lambda: watcher.state == "ready")
+        assert watcher.binds == 1
+        # healthy services cost a shallow probe, not a bind or a deep check
+        deep = service.deep
+        time.sleep(0.5)
+        assert watcher.binds == 1 and service.deep == deep
+
+        service.stop()
+        assert wait_for(lambda: watcher.binds == 2)
+        assert wait_for(lambda: watcher.state == "ready")
+
+        before = watcher.last_transition
+        adb_server.set_devices([])
+        assert wait_for(lambda: watcher.state == "offline")
+        assert watcher.last_transition > before
+        assert events == [True, False]
+    finally:
+        watcher.stop()
+
+
+def test_start_server():
+    # nothing listens on the adb port until start_server runs
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    servers = []
+
+    def start_server():
+        server = FakeAdbServer(port)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+
+    service = Service()
+    watcher = DeviceWatcher(service.start, health=service, client=AdbClient(port=port),
+                            probe_interval=0.1, retry_interval=60, start_server=start_server).start()
+    try:
+        # tracked again right away, not after retry_interval
+        assert wait_for(lambda: watcher.state == "ready")
+        assert len(servers) == 1
+    finally:
+        watcher.stop()
+        for server in servers:
+            server.shutdown()
+            server.server_close()